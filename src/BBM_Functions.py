@@ -1,73 +1,166 @@
-from utils.fire_cmap import fire_cmap  # Import the custom color map
 import os
-import nd2                       # To read Nikon ND2 files
-import tifffile as tiff          # To read and write TIFF files
+import importlib
+from Frame_Source import ND2_Source, TIF_Source  # To read Nikon ND2 and TIFF files frame by frame
 import numpy as np               # Numpy for numerical calculations
-import sep                       # Source Extractor for single molecule images
-import cv2                       # OpenCV for image processing
-import matplotlib.pyplot as plt  # Matplotlib for plotting
-import matplotlib.patches as patches # Matplotlib for patches
-from hmmlearn import hmm
-import time
-from sklearn.metrics import silhouette_score
-from sklearn.exceptions import ConvergenceWarning
+import bisect
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 
+# sep, cv2, scipy.ndimage, matplotlib, hmmlearn and sklearn take more than a second to import together, so every method
+# imports the modules it uses when it runs. Importing this file is then fast, and only the stages that run pay for their modules.
+# preload_modules() imports them all at once, e.g. in a worker process waiting for the next analysis.
+HEAVY_MODULES = ('sep', 'cv2', 'scipy.ndimage', 'matplotlib.pyplot', 'matplotlib.patches', 'hmmlearn.hmm', 'sklearn.metrics', 'sklearn.exceptions',
+                 'tifffile', 'nd2', 'utils.fire_cmap')
+SILHOUETTE_METHODS = ('exact', 'sampled', 'sklearn')    # Methods of calculate_silhouette
+
+def preload_modules(modules=HEAVY_MODULES):                     # Import the modules of the analysis ahead of time, the missing optional ones are skipped
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+UTILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils")
+CAMERAS = {'iXon_897': "Quantum_Efficiency_iXon_897.txt"}     # Quantum efficiency (%) vs wavelength of the supported cameras
+OBJECTIVES = {'default': "Objective_Efficiency.txt"}            # Transmission (%) vs wavelength of the supported objectives
+
+@functools.lru_cache(maxsize=None)
+def calibration_table(file_name):                               # Calibration table of utils/, read once per process. Columns: wavelength (nm), efficiency (%)
+    return np.loadtxt(os.path.join(UTILS_PATH, file_name), delimiter=',', skiprows=1)
+
+@functools.lru_cache(maxsize=None)
+def calibration_interpolator(file_name):                        # Efficiency (fraction) at any wavelength, linear between the table values
+    table = calibration_table(file_name)
+    wavelengths, efficiency = table[:, 0], table[:, 1] / 100
+    return lambda wavelength: np.interp(wavelength, wavelengths, efficiency)
+
+MAXIMA_DTYPE = np.dtype([('frame', np.int64), ('y', np.int64), ('x', np.int64), ('intensity', np.float64)])  # Maxima found by locate_maxima_batch
+LOCALIZATION_DTYPE = np.dtype([('frame', np.int64), ('y', np.float64), ('x', np.float64), ('intensity', np.float64), ('sigma', np.float64)])  # Sub-pixel maxima of localize_subpixel
+
 # Class with all necessary methods for the project
 class BBM_Class:
         def __init__(self):
-            self.cmap = fire_cmap
-            warnings.filterwarnings("ignore", category=ConvergenceWarning) # Suppress specific warnings if needed
+            self.thread_executor, self.thread_workers = None, 0             # Thread pool of the batched methods, created on first use
+
+        @property
+        def cmap(self):                                                     # Custom fire color map, matplotlib is imported with the first figure
+            from utils.fire_cmap import fire_cmap
+            return fire_cmap
 
-        def import_data(self, path):   # Import data from the file
+        def import_data(self, path, lazy=True):   # Import data from the file. By default frames are read from the file only when they are used
             # Check if the data is tif or nd2, otherwise raise an exception
             _, ext = os.path.splitext(path)
             if ext.lower() == '.nd2':
-                return self.import_nd2(path)
+                data, shape = self.import_nd2(path)
             elif ext.lower() == '.tif':
-                return self.import_tif(path)
+                data, shape = self.import_tif(path)
             else:
                 raise ValueError("Unsupported file format")
+            if not lazy:                                        # Read the whole movie into memory, in the native dtype
+                data = np.asarray(data)
+            return data, shape
 
-        def import_nd2(self, path):           # Import nd2 file as int numpy array
+        def import_nd2(self, path):           # Import nd2 file as a lazy frame source with the native dtype
             try:
-                data = nd2.imread(path)
-                data = np.array(data, dtype=int)
+                data = ND2_Source(path)
                 print(f"ND2 Data imported. Shape: {data.shape}")
                 return data, data.shape
             except Exception as e:
                 print(f"Failed to import ND2 file: {str(e)}")
                 raise
 
-        def import_tif(self, path):           # Import tif file as int numpy array
+        def import_tif(self, path):           # Import tif file as a lazy frame source with the native dtype
             try:
-                data = tiff.imread(path)
-                data = np.array(data, dtype=int)
+                data = TIF_Source(path)
                 print(f"TIF Data imported. Shape: {data.shape}")
                 return data, data.shape
             except Exception as e:
                 print(f"Failed to import TIF file: {str(e)}")
                 raise
 
+        def sep_compatible(self, data):       # sep only reads float32, float64 and int32 images, camera counts fit in int32
+            if data.dtype not in (np.float32, np.float64, np.int32):
+                data = data.astype(np.int32)
+            return data
+
+        def background_estimation(self, data): # Background mesh of the image, in the dtype of the image
+            import sep                        # Source Extractor for single molecule images
+            return sep.Background(data, bw=64, bh=64, fw=3, fh=3).back() # Background estimation can be adjusted if needed
+
         def background_removal (self, data):  # Remove background from the image
-            bkg = sep.Background(data, bw=64, bh=64, fw=3, fh=3) # Background estimation can be adjusted if needed
-            data_subtracted = data - np.array(np.array(bkg))
+            data = self.sep_compatible(data)
+            data_subtracted = data - self.background_estimation(data)
             return data_subtracted
 
+        def thread_pool(self, workers=None):  # Thread pool reused between calls, sep and scipy.ndimage release the GIL while they work
+            workers = workers or os.cpu_count() or 1
+            if self.thread_executor is None or self.thread_workers != workers:
+                if self.thread_executor is not None:
+                    self.thread_executor.shutdown()
+                self.thread_executor, self.thread_workers = ThreadPoolExecutor(max_workers=workers), workers
+            return self.thread_executor
+
+        def background_removal_batch(self, frames, out=None, workers=None, temporal_step=None):  # Remove the background of a stack of frames in a thread pool
+            # temporal_step = N estimates the background every N frames (and on the last frame) and interpolates linearly in between,
+            # for movies where the background drifts slowly. Without it every frame gets its own background, as in background_removal
+            frames = self.sep_compatible(np.asarray(frames))
+            if out is None:                                                      # Preallocated output, same dtype as background_removal
+                out = np.empty(frames.shape, dtype=np.float64 if temporal_step else frames.dtype)
+            n = frames.shape[0]
+            run = map if workers == 1 else self.thread_pool(workers).map
+
+            if not temporal_step or temporal_step <= 1:
+                def subtract(j):
+                    np.subtract(frames[j], self.background_estimation(frames[j]), out=out[j])
+            else:
+                anchors = list(range(0, n, temporal_step))
+                if anchors[-1] != n - 1:
+                    anchors.append(n - 1)
+                meshes = dict(zip(anchors, run(lambda j: self.background_estimation(frames[j]).astype(np.float64), anchors)))
+                def subtract(j):
+                    k = bisect.bisect_right(anchors, j) - 1
+                    left, right = anchors[k], anchors[min(k + 1, len(anchors) - 1)]
+                    if j == left or left == right:
+                        background = meshes[left]
+                    else:
+                        weight = (j - left) / (right - left)
+                        background = (1 - weight) * meshes[left] + weight * meshes[right]
+                    np.subtract(frames[j], background, out=out[j])
+            list(run(subtract, range(n)))
+            return out
+
+        def background_removal_chunks(self, data, chunk_size=256, workers=None, temporal_step=None):  # Generator of background subtracted chunks of frames, only one chunk is read at a time
+            for start in range(0, data.shape[0], chunk_size):
+                yield start, self.background_removal_batch(data[start:start + chunk_size], workers=workers, temporal_step=temporal_step)
+
+        def preprocess(self, data, chunk_size=256, workers=None, temporal_step=None):  # Background removal, normalization to [0, 1] and maximum projection in a single pass over the frames
+            normalized_data = np.empty(data.shape, dtype=np.float64)   # The only full size array, it receives the subtracted frames and is normalized in place
+            data_min, data_max, max_frame = np.inf, -np.inf, None
+            for start, chunk in self.background_removal_chunks(data, chunk_size, workers, temporal_step):
+                normalized_data[start:start + chunk.shape[0]] = chunk
+                data_min, data_max = min(data_min, np.min(chunk)), max(data_max, np.max(chunk))  # Running min/max accumulators
+                chunk_max = np.max(chunk, axis=0)                                                # Incremental maximum projection
+                max_frame = chunk_max if max_frame is None else np.maximum(max_frame, chunk_max)
+            normalized_data -= data_min                                                          # Same operations as data_normalization, without the float copy
+            normalized_data /= (data_max - data_min)
+            max_frame = (max_frame - data_min) / (data_max - data_min)                           # Normalization is monotonic, so this is the max of the normalized stack
+            print (f"Data normalized from {data_min} - {data_max} to 0 - 1")
+            return normalized_data, max_frame
+
         def data_normalization(self, data):   # Normalize the image data to range [0, 1]
             data_min, data_max = np.min(data), np.max(data)
             normalized_data = (data - data_min) / (data_max - data_min)
             print (f"Data normalized from {data_min} - {data_max} to 0 - 1")
             return normalized_data
 
-        def data_interpolation(self, data, height, width):   # Interpolate data to increase the resolution
+        def data_interpolation(self, data, height, width):   # Interpolate data to increase the resolution. For sub-pixel positions use localize_subpixel and histogram_subpixel, which never build the upsampled stack
+            import cv2                          # OpenCV for image processing
             # If initial resolution is 107.3 nm/pix, then we change the resolution to 10 nm/pix by multiplying dimenions 10 times
             if len(data.shape) == 3:            # Check if data is a 3D array
-                interpolated_slices = []        # Initialize an empty list to store the interpolated 2D slices
-                for i in range(data.shape[0]):  # Iterate over each 2D slice in the 3D array
-                    interpolated_slice = cv2.resize(data[i].astype(np.float32), (height, width), interpolation=cv2.INTER_CUBIC) # Interpolate the current 2D slice
-                    interpolated_slices.append(interpolated_slice)          # Append the interpolated slice to the list
-                data_interpolated = np.stack(interpolated_slices, axis=0)   # Stack the interpolated 2D slices back into a 3D array
+                data_interpolated = np.empty((data.shape[0], width, height), dtype=np.float32)    # cv2 sizes are (columns, rows)
+                for i in range(data.shape[0]):  # Interpolate every 2D slice straight into the output array
+                    cv2.resize(np.asarray(data[i], dtype=np.float32), (height, width), dst=data_interpolated[i], interpolation=cv2.INTER_CUBIC)
             else: # If data is not a 3D array, interpolate it directly
                 data_interpolated = cv2.resize(data.astype(np.float32), (height, width), interpolation=cv2.INTER_CUBIC)
             shape = data_interpolated.shape
@@ -75,16 +168,11 @@ class BBM_Class:
             return data_interpolated, shape
 
         def locate_maxima(self, data, h, box):              # Locate local maxima in the movies
+            import cv2
             if len(data.shape) == 3:                        # Check if data is a 3D array
-                maxima_locations_arr = []                   # Create an empty list to store the maxima locations
-                for i in range(data.shape[0]):              # Loop through all frames
-                    neighborhood_size = (2 * box + 1)       # For each pixel, checks the surrounding neighborhood box to evaluate local maxima
-                    local_max = cv2.dilate(data[i], np.ones((neighborhood_size, neighborhood_size))) == data[i] # Finds the local maxima
-                    maxima = (data[i] > h) & local_max                                     # Exclude the local maxima that are below the threshold 'h'
-                    maxima_locations = np.argwhere(maxima)                                 # Get the positions of the maxima
-                    maxima_locations_arr.append(maxima_locations)                          # Append the maxima locations to the list          
-                maxima_locations_arr_joined = np.concatenate(maxima_locations_arr, axis=0) # Join all maxima locations into a single array
-                print (f"Maxima located in {len(maxima_locations_arr_joined)} positions or about {int(round(len(maxima_locations_arr_joined) / data.shape[0]))} per frame")
+                maxima = self.locate_maxima_batch(data, h, box)
+                maxima_locations_arr_joined = np.column_stack((maxima['y'], maxima['x']))                                     # Same (row, column) positions as np.argwhere
+                maxima_locations_arr = np.split(maxima_locations_arr_joined, np.searchsorted(maxima['frame'], np.arange(1, data.shape[0])))  # Maxima locations of every frame
             else:
                 neighborhood_size = (2 * box + 1)                   # For each pixel, checks the surrounding neighborhood box to evaluate local maxima
                 local_max = cv2.dilate(data, np.ones((neighborhood_size, neighborhood_size))) == data # Finds the local maxima
@@ -94,67 +182,166 @@ class BBM_Class:
                 print (f"Maxima located in {len(maxima_locations_arr_joined)} positions")
             return maxima_locations_arr, maxima_locations_arr_joined, len(maxima_locations_arr_joined)
 
-        def histogram_2d (self, shape, maxima_locations):   # Create a 2D histogram of the maxima
+        def maxima_candidates(self, data, box):             # Local maxima of a single image for any threshold, sorted by decreasing value
+            import cv2
+            neighborhood_size = (2 * box + 1)
+            local_max = cv2.dilate(data, np.ones((neighborhood_size, neighborhood_size))) == data # Same local maxima as locate_maxima
+            candidates, values = np.argwhere(local_max), data[local_max]
+            order = np.argsort(-values, kind='stable')
+            return candidates[order], values[order]
+
+        def threshold_candidates(self, candidates, values, h):  # Positions of the candidates above the threshold 'h', as locate_maxima(data, h, box) finds them
+            return candidates[:np.searchsorted(-values, -h, side='left')]
+
+        def locate_maxima_batch(self, data, h, box, chunk_size=256, workers=None, verbose=True):  # Local maxima of every frame, one maximum filter per chunk of frames
+            # Returns a structured array with the frame, y (row), x (column) and intensity of every maxima, ordered by frame
+            from scipy import ndimage                       # Scipy for n-dimensional filters
+            neighborhood_size = (2 * box + 1)               # For each pixel, checks the surrounding neighborhood box of its own frame
+            def chunk_maxima(start):
+                frames = np.asarray(data[start:start + chunk_size])
+                local_max = ndimage.maximum_filter(frames, size=(1, neighborhood_size, neighborhood_size), mode='nearest') == frames  # Same as cv2.dilate, the border never adds new values
+                frame, y, x = np.nonzero((frames > h) & local_max)                 # Exclude the local maxima that are below the threshold 'h'
+                chunk = np.empty(frame.size, dtype=MAXIMA_DTYPE)
+                chunk['frame'], chunk['y'], chunk['x'], chunk['intensity'] = frame + start, y, x, frames[frame, y, x]
+                return chunk
+            starts = range(0, data.shape[0], chunk_size)
+            run = map if workers == 1 or len(starts) == 1 else self.thread_pool(workers).map  # Chunks across threads, in order
+            maxima = np.concatenate(list(run(chunk_maxima, starts))) if len(starts) else np.empty(0, dtype=MAXIMA_DTYPE)
+            if verbose:
+                print (f"Maxima located in {len(maxima)} positions or about {int(round(len(maxima) / max(data.shape[0], 1)))} per frame")
+            return maxima
+
+        def localize_subpixel(self, data, maxima, radius=3, method='gaussian', chunk_size=256):  # Sub-pixel position of every maxima of locate_maxima_batch, fitted in the (2*radius+1)^2 window around it
+            # method='gaussian' fits a 2-D Gaussian to the log of the window (weighted least squares, closed form), 'centroid' is the intensity weighted mean position
+            localizations = np.empty(len(maxima), dtype=LOCALIZATION_DTYPE)
+            localizations['frame'], localizations['intensity'] = maxima['frame'], maxima['intensity']
+            offsets = np.arange(-radius, radius + 1)
+            dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+            height, width = data.shape[1], data.shape[2]
+            bounds = np.searchsorted(maxima['frame'], np.arange(0, data.shape[0] + chunk_size, chunk_size))  # Maxima are ordered by frame
+            for start, first, last in zip(range(0, data.shape[0], chunk_size), bounds[:-1], bounds[1:]):
+                if first == last:
+                    continue
+                frames = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+                chunk = maxima[first:last]
+                rows = np.clip(chunk['y'][:, None, None] + dy, 0, height - 1)   # Windows of all the maxima of the chunk at once, edge pixels repeated
+                cols = np.clip(chunk['x'][:, None, None] + dx, 0, width - 1)
+                windows = frames[(chunk['frame'] - start)[:, None, None], rows, cols]
+                windows = windows - windows.min(axis=(1, 2), keepdims=True)       # Local background
+                y, x, sigma = self.fit_windows(windows, dy, dx, method)
+                localizations['y'][first:last], localizations['x'][first:last] = chunk['y'] + y, chunk['x'] + x
+                localizations['sigma'][first:last] = sigma
+            return localizations
+
+        def fit_windows(self, windows, dy, dx, method='gaussian'):  # Offsets (y, x) of the spot center from the window center and the spot width, for a stack of windows
+            weights = windows.reshape(len(windows), -1)
+            total = np.maximum(weights.sum(axis=1), 1e-12)
+            y = weights @ dy.ravel() / total                                    # Centroid
+            x = weights @ dx.ravel() / total
+            sigma = np.sqrt(np.maximum(weights @ ((dy.ravel() ** 2 + dx.ravel() ** 2) / 2) / total - (y ** 2 + x ** 2) / 2, 0))
+            if method == 'centroid':
+                return y, x, sigma
+            # log(I) = a + b x + c y + d x^2 + e y^2 with weights I^2, solved for all windows at once (Gaussian fit of Guo 2011)
+            design = np.column_stack((np.ones(dx.size), dx.ravel(), dy.ravel(), dx.ravel() ** 2, dy.ravel() ** 2))
+            log_values = np.log(np.maximum(weights, 1e-12 * np.max(weights, axis=1, keepdims=True) + 1e-300))
+            squared = weights ** 2
+            normal = np.einsum('pi,np,pj->nij', design, squared, design)
+            normal += np.eye(5) * 1e-12 * np.trace(normal, axis1=1, axis2=2)[:, None, None] + np.eye(5) * 1e-300   # Flat windows stay solvable
+            a, b, c, d, e = np.linalg.solve(normal, np.einsum('pi,np->ni', design, squared * log_values)[:, :, None])[:, :, 0].T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gaussian_x, gaussian_y = -b / (2 * d), -c / (2 * e)
+                gaussian_sigma = np.sqrt((-1 / (2 * d) - 1 / (2 * e)) / 2)
+            radius = dy.max()
+            valid = (d < 0) & (e < 0) & (np.abs(gaussian_x) <= radius) & (np.abs(gaussian_y) <= radius)  # Otherwise keep the centroid
+            return np.where(valid, gaussian_y, y), np.where(valid, gaussian_x, x), np.where(valid, gaussian_sigma, sigma)
+
+        def histogram_subpixel(self, shape, localizations, upsampling=10):  # Count image of the sub-pixel positions on a grid upsampling times finer, as after data_interpolation
+            height, width = shape[-2] * upsampling, shape[-1] * upsampling
+            rows = np.clip(np.floor((localizations['y'] + 0.5) * upsampling).astype(np.int64), 0, height - 1)    # Pixel i covers [i - 0.5, i + 0.5)
+            cols = np.clip(np.floor((localizations['x'] + 0.5) * upsampling).astype(np.int64), 0, width - 1)
+            return np.bincount(rows * width + cols, minlength=height * width).reshape(height, width).astype(np.float64)
+
+        def maxima_counts(self, shape, maxima_locations):   # Count image of the maxima. maxima_locations is an array or an iterable of per-frame/per-chunk arrays, which are accumulated one by one
             if len(shape) == 3:                             # Define is shape 2- or 3-dimensional
                 height, width = shape[1], shape[2]
             else:
                 height, width = shape[0], shape[1]
-            histogram_2d = np.zeros((height, width))        # Extract the final dimensions for the histogram
-            for i in range(maxima_locations.shape[0]):      # Fill the histogram with the maxima locations
-                histogram_2d[int(maxima_locations[i, 0]), int(maxima_locations[i, 1])] += 1 
+            if isinstance(maxima_locations, np.ndarray):
+                maxima_locations = [maxima_locations]
+            counts = np.zeros(height * width)
+            for locations in maxima_locations:
+                locations = np.asarray(locations)
+                if locations.dtype.names:                   # Structured maxima from locate_maxima_batch
+                    locations = np.column_stack((locations['y'], locations['x']))
+                if locations.size:
+                    counts += np.bincount(locations[:, 0].astype(int) * width + locations[:, 1].astype(int), minlength=height * width)
+            return counts.reshape(height, width)
+
+        def histogram_2d (self, shape, maxima_locations):   # Create a 2D histogram of the maxima
+            histogram_2d = self.maxima_counts(shape, maxima_locations)
             print ("2-D histogram created")
             return histogram_2d
 
-        def histogram_2d_gradient(self, shape, maxima_locations):   # Similar to the previous function, but with a box around the maxima. Center = 3, First layes = 2, Second layer = 3. 
-            if len(shape) == 3:                                     # Define is shape 2- or 3-dimensional
-                height, width = shape[1], shape[2]
-            else:
-                height, width = shape[0], shape[1]
-            histogram_2d = np.zeros((height, width))                # Extract the final dimensions for the histogram
-            for location in maxima_locations:                       # Process each maxima location
-                x, y = int(location[0]), int(location[1])
-                histogram_2d[x, y] += 3                             # Add 3 at the maxima location
-                for dx in [-1, 0, 1]:                               # Add to the immediate neighbors value of 2
-                    for dy in [-1, 0, 1]:
-                        nx, ny = x + dx, y + dy
-                        if 0 <= nx < height and 0 <= ny < width and (dx != 0 or dy != 0):
-                            histogram_2d[nx, ny] += 2
-                for dx in [-2, -1, 0, 1, 2]:                        # Add to the next layer of neighbors value of 1
-                    for dy in [-2, -1, 0, 1, 2]:
-                        if abs(dx) == 2 or abs(dy) == 2:
-                            nx, ny = x + dx, y + dy
-                            if 0 <= nx < height and 0 <= ny < width:
-                                histogram_2d[nx, ny] += 1
+        def histogram_2d_gradient(self, shape, maxima_locations):   # Similar to the previous function, but with a box around the maxima. Center = 3, First layes = 2, Second layer = 1.
+            histogram_2d = self.counts_gradient(self.maxima_counts(shape, maxima_locations))
             print("2-D histogram created")
             return histogram_2d
 
+        def counts_gradient(self, counts):                          # Gradient histogram of a count image, so a count image accumulated over time gives the same histogram
+            kernel = np.ones((5, 5))                                # Second layer of neighbors adds 1
+            kernel[1:4, 1:4] = 2                                    # Immediate neighbors add 2
+            kernel[2, 2] = 3                                        # Maxima location adds 3
+            # Convolving the count image spreads every maxima with the kernel, the zero border drops the parts outside the image as the bounds checks did
+            from scipy import ndimage
+            return ndimage.convolve(counts, kernel, mode='constant', cval=0)
+
         def max_frame(self, data):                                  # Max all frames in the movie
             data_max = np.max(data, axis=0)                         # Max all frames in the movie
             return data_max                    
 
-        def extract_intensities (self, data, maxima_locations, maxima_quantity, frame_interval):       # Extract emission withn 5 pixels around maxima vs time data
-            emissions = np.zeros((maxima_quantity + 1, data.shape[0]))                                 # Create an empty array
-            emissions[0] = (np.arange(0, data.shape[0] * frame_interval, frame_interval))/1000         # Fill array with the time in seconds
-            for i in range(maxima_quantity):                                                           # Fill array with the emission data
-                x, y = maxima_locations[i]
-                for j in range(data.shape[0]):
-                    emissions[i + 1, j] = data[j, x, y]
+        def time_axis(self, n_frames, frame_interval):              # Time of every frame in seconds, frame_interval in ms
+            return (np.arange(0, n_frames * frame_interval, frame_interval))/1000
+
+        def extract_counts(self, data, maxima_locations, maxima_quantity, box=None):  # Counts of every particle vs frame, (particles, frames)
+            # box=None reads the maxima pixel, box=3 the maximum of the 6x6 pixels around it. Integer movies keep their dtype (uint16 for the cameras), others are stored as float32
+            dtype = data.dtype if np.issubdtype(data.dtype, np.integer) else np.float32
+            counts = np.zeros((maxima_quantity, data.shape[0]), dtype=dtype)
+            if maxima_quantity == 0:
+                return counts
+            x, y = np.asarray(maxima_locations[:maxima_quantity], dtype=int).T                              # Pixel of every particle
+            if box is None:
+                for start, stop in self.frame_chunks(data.shape[0], maxima_quantity + data.shape[1] * data.shape[2]):  # Gather all particles of a chunk of frames at once
+                    counts[:, start:stop] = data[start:stop, x, y].T
+                return counts
+            offsets = np.arange(-box, box)                                                                  # Box [x - 3, x + 3) around every particle, as in data[j, x-3:x+3, y-3:y+3]
+            # Clipping the indices to the image repeats the edge pixels, which are already inside the bounded box, so the maximum is unchanged
+            rows = np.clip(x[:, None] + offsets, 0, data.shape[1] - 1)[:, :, None]                          # (particles, 6, 1), x corresponds to shape[1]
+            cols = np.clip(y[:, None] + offsets, 0, data.shape[2] - 1)[:, None, :]                          # (particles, 1, 6), y corresponds to shape[2]
+            for start, stop in self.frame_chunks(data.shape[0], maxima_quantity * (2 * box) ** 2 + data.shape[1] * data.shape[2]):  # Gather the boxes of a chunk of frames and reduce over the box axes
+                frames = np.asarray(data[start:stop])
+                counts[:, start:stop] = frames[:, rows, cols].max(axis=(2, 3)).T
+            return counts
+
+        def extract_intensities (self, data, maxima_locations, maxima_quantity, frame_interval):       # Extract emission at the maxima pixel vs time data
+            emissions = np.zeros((maxima_quantity + 1, data.shape[0]))                                 # Time in row 0, one particle per row
+            emissions[0] = self.time_axis(data.shape[0], frame_interval)                               # Fill array with the time in seconds
+            emissions[1:] = self.extract_counts(data, maxima_locations, maxima_quantity)
             return emissions
 
-        def extract_intensities_max (self, data, maxima_locations, maxima_quantity, frame_interval):        # Extract emission withn 5 pixels around maxima vs time data
-            emissions = np.zeros((maxima_quantity + 1, data.shape[0]))                                      # Create an empty array
-            emissions[0] = (np.arange(0, data.shape[0] * frame_interval, frame_interval))/1000              # Fill array with the time in seconds
-            for i in range(maxima_quantity):                                                                # Fill array with the emission data
-                x, y = maxima_locations[i]
-                for j in range(data.shape[0]):                                                              # Define the bounds of the box ensuring they are within the image boundaries
-                    x_min = max(x - 3, 0)
-                    x_max = min(x + 3, data.shape[1])                                                       # Use shape[1] as x corresponds to columns
-                    y_min = max(y - 3, 0)
-                    y_max = min(y + 3, data.shape[2])                                                       # Use shape[2] as y corresponds to rows
-                    emissions[i + 1, j] = np.max(data[j, x_min:x_max, y_min:y_max])                         # Extract the maximum value safely within the bounded region
+        def extract_intensities_max (self, data, maxima_locations, maxima_quantity, frame_interval, box=3):  # Extract emission withn 6x6 pixels around maxima vs time data
+            emissions = np.zeros((maxima_quantity + 1, data.shape[0]))                                      # Time in row 0, one particle per row
+            emissions[0] = self.time_axis(data.shape[0], frame_interval)                                    # Fill array with the time in seconds
+            emissions[1:] = self.extract_counts(data, maxima_locations, maxima_quantity, box)
             return emissions
 
-        def plot_images(self, data, maxima=None, normalize=True, cmap=fire_cmap, radius=5, axis=False, title=None, lable='Normalized Detected Counts'): # Plot the image
+        def frame_chunks(self, n_frames, values_per_frame, chunk_bytes=2**26):  # Split the frames into chunks so that the frames read and the gathered values take about chunk_bytes
+            step = max(1, int(chunk_bytes // (8 * max(values_per_frame, 1))))
+            return [(start, min(start + step, n_frames)) for start in range(0, n_frames, step)]
+
+        def plot_images(self, data, maxima=None, normalize=True, cmap=None, radius=5, axis=False, title=None, lable='Normalized Detected Counts'): # Plot the image, with the fire color map by default
+            import matplotlib.pyplot as plt   # Matplotlib for plotting
+            import matplotlib.patches as patches
+            cmap = self.cmap if cmap is None else cmap
             fig, ax = plt.subplots(1, 1, figsize=(6.5, 5))
             
             if normalize:
@@ -179,26 +366,62 @@ class BBM_Class:
                 ax.set_title(title)                                                                # Add title to the plot
             return fig, ax
 
-        def states_assignment (self, number_of_states, emissions, i):   # Function to assign states to the emissions
-            gm = hmm.GMMHMM(n_components=number_of_states)              # Initialize HMM with sertain number states to look for
+        def fit_hmm(self, number_of_states, emissions, i, random_state=None):  # Fitted HMM of a trace, kept by the caller so the chosen model is not fitted twice
+            from hmmlearn import hmm
+            from sklearn.exceptions import ConvergenceWarning
+            warnings.filterwarnings("ignore", category=ConvergenceWarning) # Suppress specific warnings if needed
+            gm = hmm.GMMHMM(n_components=number_of_states, random_state=random_state)     # Initialize HMM with sertain number states to look for, fixed seed makes the fit reproducible
             gm.fit(emissions[i + 1].reshape(-1, 1))                     # Fit HMM to the intensity values
+            return gm
+
+        def states_assignment (self, number_of_states, emissions, i, random_state=None):   # Function to assign states to the emissions
+            gm = self.fit_hmm(number_of_states, emissions, i, random_state)
             states = gm.predict(emissions[i + 1].reshape(-1, 1))        # Predict states
             return states
 
-        def calculate_silhouette(self, emissions, states, i, retry_count=3, delay=1):           # Define a function to calculate silhouette coefficient with retries
-            for attempt in range(retry_count):
-                try:
-                    silhouette_avg = silhouette_score(emissions[i + 1].reshape(-1, 1), states)  # Attempt to calculate the silhouette score
-                    return silhouette_avg                                                       # If the calculation is successful, return the result
-                except Exception as e:
-                    print(f"Attempt {attempt + 1} failed with error: {e}")
-                    if attempt == retry_count - 1:                                              # If it's the last attempt, handle the failure
-                        print("Max retries reached, skipping this calculation.")
-                        return 0                                                                # Return 0 or any default value as appropriate
-                    else:
-                        time.sleep(delay)                                                       # Optional: wait before retrying
+        def silhouette_1d(self, values, labels):        # Exact silhouette coefficient of 1-D data in O(n log n), same result as sklearn silhouette_score
+            values, labels = np.asarray(values, dtype=np.float64).ravel(), np.asarray(labels).ravel()
+            clusters = np.unique(labels)
+            n = values.size
+            if not 2 <= clusters.size <= n - 1:
+                raise ValueError(f"Number of labels is {clusters.size}. Valid values are 2 to n_samples - 1 (inclusive)")
+            distance_sums = np.empty((clusters.size, n))                # Sum of |x - y| over the members y of every cluster, for every x
+            sizes = np.empty(clusters.size, dtype=int)
+            for k, cluster in enumerate(clusters):
+                members = np.sort(values[labels == cluster])
+                prefix = np.concatenate(([0], np.cumsum(members)))
+                below = np.searchsorted(members, values, side='right') # Members smaller or equal to x
+                distance_sums[k] = values * below - prefix[below] + (prefix[-1] - prefix[below]) - values * (members.size - below)
+                sizes[k] = members.size
+            own = np.searchsorted(clusters, labels)
+            samples = np.arange(n)
+            a = distance_sums[own, samples] / np.maximum(sizes[own] - 1, 1)   # Mean distance inside the own cluster
+            other = distance_sums / sizes[:, None]
+            other[own, samples] = np.inf
+            b = other.min(axis=0)                                             # Mean distance to the closest other cluster
+            with np.errstate(invalid='ignore', divide='ignore'):
+                silhouette = np.nan_to_num((b - a) / np.maximum(a, b))
+            silhouette[sizes[own] == 1] = 0                                  # Single member clusters have a coefficient of 0
+            return float(np.mean(silhouette))
+
+        def calculate_silhouette(self, emissions, states, i, method='exact', sample_size=1000, random_state=None):  # Silhouette coefficient of the states of a trace
+            # 'exact' sorts the 1-D trace (O(n log n)), 'sampled' uses sklearn on sample_size frames, 'sklearn' builds the full O(n^2) distance matrix
+            if method not in SILHOUETTE_METHODS:
+                raise ValueError(f"Unknown silhouette method: {method}")
+            trace = emissions[i + 1]
+            try:
+                if method == 'exact':
+                    return self.silhouette_1d(trace, states)
+                from sklearn.metrics import silhouette_score
+                if method == 'sampled' and trace.size > sample_size:
+                    return silhouette_score(trace.reshape(-1, 1), states, sample_size=sample_size, random_state=random_state)
+                return silhouette_score(trace.reshape(-1, 1), states)
+            except ValueError as e:                                     # A single state has no silhouette coefficient
+                print(f"Silhouette coefficient not defined: {e}")
+                return 0
 
         def plot_emissions(self, emissions, i, states, mono=False, lable_Oy = 'Detected Counts'): # Plot emissions with states
+            import matplotlib.pyplot as plt
             state_colors = {0: "r", 1: "g", 2: "b", 3: "c", 4: "m"} # Define a color map for states
             fig, ax = plt.subplots(1, 1, figsize=(10, 6))
             ax.plot(emissions[0], emissions[i + 1], color='k', alpha=0.5)
@@ -220,29 +443,26 @@ class BBM_Class:
 
             return fig, ax
         
-        def count_convert(self, trace_Oy, bias_offset = 200, pre_amplifier_gain = 5.1, em_gain = 285, wavelength = 677):# Convert counts into photons. Defoult wavelength 677 for SF8
+        def count_convert(self, trace_Oy, bias_offset = 200, pre_amplifier_gain = 5.1, em_gain = 285, wavelength = 677, camera = 'iXon_897'):# Convert counts into photons, for a trace or a whole (traces, frames) matrix. Defoult wavelength 677 for SF8
             if wavelength <= 665 or wavelength >= 705:                                                                    # Check if the wavelength is within the optical filters transmission range
                 print ("The wavelength is out of range")
-            if wavelength >= 665 and wavelength <= 705: 
-                
-                current_dir = os.path.dirname(os.path.abspath(__file__))                                                # Get the current directory and Load the quantum efficiency of the Andor iXon 897 camera
-                quantum_efficiency = np.loadtxt(os.path.join(current_dir, "utils/Quantum_Efficiency_iXon_897.txt"), delimiter=',', skiprows=1)
-
-                qe_data = quantum_efficiency[np.where(quantum_efficiency[:, 0] == wavelength)] / 100                    # Extract the quantum efficiency in % for the given wavelength
-                trace_Oy = ((trace_Oy - bias_offset) * pre_amplifier_gain) / (em_gain * qe_data[0, 1])                  # Convert counts into photons
+            if wavelength >= 665 and wavelength <= 705:
+                if camera not in CAMERAS:
+                    raise ValueError(f"Unknown camera: {camera}")
+                qe_data = calibration_interpolator(CAMERAS[camera])(wavelength)                                         # Quantum efficiency of the camera at the given wavelength
+                trace_Oy = ((trace_Oy - bias_offset) * pre_amplifier_gain) / (em_gain * qe_data)                        # Convert counts into photons
             return trace_Oy
-        
-        def recorded_to_emitted(self, trace_Oy, NA = 1.49, n = 1.515, n_ellements = 4, wavelength = 677):  # Convert recieved photons by camera into emitted photons by the sample
+
+        def recorded_to_emitted(self, trace_Oy, NA = 1.49, n = 1.515, n_ellements = 4, wavelength = 677, objective = 'default'):  # Convert recieved photons by camera into emitted photons by the sample, for a trace or a matrix
             if wavelength <= 665 or wavelength >= 705:                                                       # Check if the wavelength is within the optical filters transmission range
                 print ("The wavelength is out of range")
-            if wavelength >= 665 and wavelength <= 705:    
-                theta = np.degrees(np.arcsin(NA / n))                                                      # Calculate theta (half-angle of the collected light cone 
+            if wavelength >= 665 and wavelength <= 705:
+                if objective not in OBJECTIVES:
+                    raise ValueError(f"Unknown objective: {objective}")
+                theta = np.degrees(np.arcsin(NA / n))                                                      # Calculate theta (half-angle of the collected light cone
                 eta_coll = (1 - np.cos(theta)) / 2                                                         # Calculate the light collection efficiency (eta_coll)
 
-                current_dir = os.path.dirname(os.path.abspath(__file__))                                   # Get the current directory and Load the objective transmission efficiency data
-                OL_efficiency = np.loadtxt(os.path.join(current_dir, "utils/Objective_Efficiency.txt"), delimiter=',', skiprows=1)
-                
-                OL_data = OL_efficiency[np.where(OL_efficiency[:, 0] == wavelength)] / 100                 # Extract the quantum efficiency data for the given wavelength in %
-                eta_opt = OL_data[0, 1] * 0.96 ** n_ellements                                              # Calculate the optical efficiency (eta_opt)
+                OL_data = calibration_interpolator(OBJECTIVES[objective])(wavelength)                      # Transmission efficiency of the objective at the given wavelength
+                eta_opt = OL_data * 0.96 ** n_ellements                                                    # Calculate the optical efficiency (eta_opt)
                 trace_Oy = (trace_Oy / (eta_coll * eta_opt))                                               # Convert the recieved photons into emitted photons
-            return trace_Oy
\ No newline at end of file
+            return trace_Oy
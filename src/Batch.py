@@ -0,0 +1,155 @@
+import os
+os.environ['MPLBACKEND'] = 'Agg'        # No display in batch mode, figures are only saved to files. matplotlib itself is imported with the first figure
+import sys
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from BBM_Functions import BBM_Class, SILHOUETTE_METHODS
+BBM = BBM_Class()                       # Create an instance of the class
+from Pipeline import data_optimization, create_results_folders, get_positions, extract_traces, classify_traces, process_traces, stage_key, HMM_BACKENDS, MODEL_SELECTIONS, LINKING_MODES
+from Results_Store import Results_Store
+from Trace_Plots import Plot_Renderer, PLOT_MODES
+from Stage_Profiler import Stage_Profiler
+from Stage_Cache import Stage_Cache, Classification_Checkpoint
+
+# Headless batch analysis: runs the same workflow as GUIs.py on many movies, one worker process per movie
+#
+#   python Batch.py <directory or glob> [...] --params params.json [--workers 4] [--memory-budget 16]
+#
+# The parameter file is a JSON dictionary with the values asked by the "Parameters Input" window and the 'h' slider:
+#   {"frame_interval": 11, "n_frames": null, "pre_amp": 5.1, "em_gain": 285, "wavelength": 677, "h": 0.2}
+# n_frames = null processes the full movie. The optional "background_step": N estimates the background every N frames and interpolates in between,
+# and "hmm_backend": "fast" classifies the traces with the vectorized Gaussian HMM of Fast_HMM.py instead of hmmlearn, "steps" with the
+# change-point detection of Step_Detection.py, which counts any number of bleach steps (its model selection is "steps").
+# "model_selection" is "silhouette", "bic" or "likelihood_ratio", "silhouette_method" is "exact", "sampled" or "sklearn".
+# All the results are saved in <movie>_Results/Results.npz (see Results_Store.py), "legacy_txt": false skips the per-trace txt files.
+# "plots" is "all", "lazy" (trace figures drawn by a pool of processes while the analysis goes on), "summary" (no trace figures) or "none".
+# "profile": true writes the time, CPU time, peak memory and throughput of every stage to <movie>_Results/Profile.json.
+# "cache_folder": "path" keeps the results of the stages there (see Stage_Cache.py, at most "cache_size_gb"), so a rerun with another h or
+# frame interval only recomputes what changed and an interrupted classification resumes from the last saved trace.
+# "subpixel": N fits the sub-pixel position of every maxima and saves their histogram on a grid N times finer (10 for ~10 nm pixels).
+# "particle_linking": "kdtree" groups the maxima into particles with a KD-tree (Particle_Linking.py) instead of the dense 2-D histogram.
+
+SUPPORTED_EXTENSIONS = ('.nd2', '.tif')
+DEFAULT_PARAMETERS = {'frame_interval': 11, 'n_frames': None, 'pre_amp': 5.1, 'em_gain': 285, 'wavelength': 677, 'h': 0.2, 'background_step': None, 'hmm_backend': 'hmmlearn',
+                      'model_selection': 'silhouette', 'silhouette_method': 'exact', 'legacy_txt': True,
+                      'plots': 'all', 'profile': False, 'cache_folder': None, 'cache_size_gb': 20,
+                      'subpixel': None, 'particle_linking': 'histogram'}
+MEMORY_FACTOR = 16                      # Peak memory of one analysis relative to the movie size on disk (background subtracted float stack and its normalized copy)
+
+def load_parameters(path):              # Read the parameter file and fill the missing values with the GUI defaults
+    with open(path) as f:
+        user_parameters = json.load(f)
+    unknown = set(user_parameters) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters in {path}: {', '.join(sorted(unknown))}")
+    parameters = dict(DEFAULT_PARAMETERS, **user_parameters)
+    if parameters['hmm_backend'] == 'steps' and 'model_selection' not in user_parameters:
+        parameters['model_selection'] = 'steps'                 # The steps backend decides on the height of the last bleach step
+    if parameters['frame_interval'] <= 0 or (parameters['n_frames'] is not None and parameters['n_frames'] <= 0):
+        raise ValueError("Please enter positive numbers.")
+    for name, choices in (('hmm_backend', HMM_BACKENDS), ('model_selection', MODEL_SELECTIONS), ('silhouette_method', SILHOUETTE_METHODS),
+                          ('plots', PLOT_MODES), ('particle_linking', LINKING_MODES)):  # Checked before any movie, not in the worker after its preprocessing
+        if parameters[name] not in choices:
+            raise ValueError(f"Unknown {name} in {path}: {parameters[name]!r}, expected one of {', '.join(choices)}")
+    if (parameters['hmm_backend'] == 'steps') != (parameters['model_selection'] == 'steps'):
+        raise ValueError(f"The steps backend is only used with the steps model selection in {path}")
+    return parameters
+
+def collect_files(inputs):              # Expand directories and glob patterns into a sorted list of movies
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        files += [path for path in candidates if os.path.isfile(path) and os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS]
+    return sorted(set(os.path.abspath(path) for path in files))
+
+def workers_for_budget(files, memory_budget, workers=None):    # Number of movies that can be analysed at the same time within the memory budget (GB)
+    workers = workers or os.cpu_count() or 1
+    if memory_budget is not None:
+        largest_movie = max(os.path.getsize(path) for path in files) * MEMORY_FACTOR
+        workers = min(workers, max(1, int(memory_budget * 1024**3 // largest_movie)))
+    return max(1, min(workers, len(files)))
+
+def analyse_movie(file_path, parameters, trace_workers=1):     # Full analysis of one movie, same steps and outputs as GUIs.py
+    profiler = Stage_Profiler(parameters['profile'])
+    cache = Stage_Cache(parameters['cache_folder'], parameters['cache_size_gb'] * 1024**3) if parameters['cache_folder'] else None
+    folder_path = os.path.dirname(file_path)
+    with profiler.stage('import_data'):
+        data, shape = BBM.import_data(file_path)               # Import the data in nd2 or tif formats
+    n_frames = parameters['n_frames'] or shape[0]
+    profiler.count('import_data', frames=n_frames)
+
+    data = data [0:n_frames]                                   # Crop out corrupted data
+    data_full = data                                           # Save the full data for later use
+    data_key = stage_key(cache, 'data_optimization', cache.file_key(file_path) if cache else None, n_frames=n_frames, temporal_step=parameters['background_step'])
+    data, shape, max_frame = data_optimization(data_full, shape, n_frames, parameters['background_step'], profiler, cache, data_key)
+
+    results_path, positive_path, false_positive_path = create_results_folders(file_path, folder_path)
+    store = Results_Store(results_path, parameters=parameters)
+    plots = Plot_Renderer(parameters['plots'], profiler=profiler)
+    positions_key = stage_key(cache, 'positions', data_key, h=parameters['h'], subpixel=bool(parameters['subpixel']), linking=parameters['particle_linking'])
+    maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = get_positions(data, shape, parameters['h'], max_frame, results_path, store, parameters['legacy_txt'],
+                                                                                                 plots.summary, profiler, cache, positions_key,
+                                                                                                 lambda: data_optimization(data_full, data_full.shape, n_frames, parameters['background_step'], profiler)[0],
+                                                                                                 parameters['subpixel'], parameters['particle_linking'])
+    del data                                                   # Remove the data to free up memory
+
+    traces = extract_traces(data_full, maxima_locations_arr_joined, maxima_locations_quantity, parameters['frame_interval'], profiler,
+                            cache, stage_key(cache, 'traces', positions_key, frame_interval=parameters['frame_interval']))
+    del data_full
+    traces.set_conversion(parameters['pre_amp'], parameters['em_gain'], parameters['wavelength'])   # The photons are converted trace by trace when they are saved
+    store.set_traces(traces)
+    checkpoint = None
+    if cache is not None:                                      # The traces only depend on the positions, not on the frame interval or the conversion
+        checkpoint = Classification_Checkpoint(cache, stage_key(cache, 'classification', positions_key, backend=parameters['hmm_backend'], selection=parameters['model_selection'],
+                                                                silhouette_method=parameters['silhouette_method']), maxima_locations_quantity, traces.n_frames)
+    for i, *classification in classify_traces(traces, maxima_locations_quantity, workers=trace_workers, backend=parameters['hmm_backend'],
+                                              selection=parameters['model_selection'], silhouette_method=parameters['silhouette_method'], profiler=profiler, checkpoint=checkpoint):
+        process_traces(traces, i, positive_path, false_positive_path, classification=classification, selection=parameters['model_selection'],
+                       store=store, legacy_txt=parameters['legacy_txt'], plots=plots, profiler=profiler)
+    with profiler.stage('save_results', traces=maxima_locations_quantity):
+        store.save()
+    with profiler.stage('plot_traces'):
+        plots.close()                                          # Wait for the figures drawn in the background
+    profiler.save(results_path, file=os.path.basename(file_path), parameters=parameters, trace_workers=trace_workers)
+    return results_path, maxima_locations_quantity
+
+def run_batch(files, parameters, workers=None, memory_budget=None, trace_workers=1): # Analyse all the movies in a process pool, returns the list of failed movies
+    workers = workers_for_budget(files, memory_budget, workers)
+    print(f"Analysing {len(files)} movies with {workers} worker(s)")
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyse_movie, path, parameters, trace_workers): path for path in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                results_path, quantity = future.result()
+                print(f"{os.path.basename(path)}: {quantity} traces saved to {results_path}")
+            except Exception as e:
+                print(f"{os.path.basename(path)}: analysis failed: {e}")
+                failed.append(path)
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless BBM analysis of many ND2/TIF movies")
+    parser.add_argument('inputs', nargs='+', help="Directories or glob patterns with .nd2/.tif movies")
+    parser.add_argument('--params', required=True, help="JSON file with frame_interval, n_frames, pre_amp, em_gain, wavelength and h")
+    parser.add_argument('--workers', type=int, default=None, help="Maximum number of movies analysed at the same time (default: number of CPUs)")
+    parser.add_argument('--trace-workers', type=int, default=1, help="Processes used by each movie for the HMM classification of its traces")
+    parser.add_argument('--memory-budget', type=float, default=None, help="Memory available for the analysis in GB, limits the number of workers")
+    args = parser.parse_args(argv)
+
+    parameters = load_parameters(args.params)
+    files = collect_files(args.inputs)
+    if not files:
+        print("No .nd2 or .tif files found")
+        return 1
+    failed = run_batch(files, parameters, args.workers, args.memory_budget, args.trace_workers)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
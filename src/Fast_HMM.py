@@ -0,0 +1,135 @@
+import numpy as np
+
+# Gaussian HMM with 1 or 2 states fitted on a whole batch of 1-D traces at once, held as a (n_traces, n_frames) array.
+# Baum-Welch runs in log space and every step is vectorized across the traces and the states, only the time axis is a
+# Python loop. Used by process_traces as a lighter alternative to hmmlearn.GMMHMM for step-photobleaching traces.
+#
+#   model = Gaussian_HMM(2).fit(traces)
+#   states = model.predict(traces)        # Viterbi path of every trace, (n_traces, n_frames)
+
+class Gaussian_HMM:
+        def __init__(self, n_components=2, n_iter=20, tol=1e-2, min_covar=1e-3, batch_size=256):
+            self.n_components = n_components
+            self.n_iter = n_iter                # Maximum number of Baum-Welch iterations
+            self.tol = tol                      # A trace stops when its log-likelihood improves less than tol, as in hmmlearn
+            self.min_covar = min_covar          # Variance floor, relative to the variance of the trace
+            self.batch_size = batch_size        # Traces fitted together, bounds the (traces, frames, states, states) arrays
+
+        def kmeans_init(self, x, n_iter=10):    # 1-D k-means of every trace, starting from the quantiles
+            K = self.n_components
+            means = np.quantile(x, (np.arange(K) + 0.5) / K, axis=1).T                    # (traces, states)
+            for _ in range(n_iter):
+                labels = np.argmin(np.abs(x[:, :, None] - means[:, None, :]), axis=2)      # Closest center of every frame
+                one_hot = labels[:, :, None] == np.arange(K)
+                counts = one_hot.sum(axis=1)
+                sums = (one_hot * x[:, :, None]).sum(axis=1)
+                means = np.where(counts > 0, sums / np.maximum(counts, 1), means)          # Empty clusters keep their center
+            labels = np.argmin(np.abs(x[:, :, None] - means[:, None, :]), axis=2)
+            one_hot = labels[:, :, None] == np.arange(K)
+            counts = np.maximum(one_hot.sum(axis=1), 1)
+            variances = (one_hot * (x[:, :, None] - means[:, None, :]) ** 2).sum(axis=1) / counts
+            transitions = np.ones((x.shape[0], K, K))                                     # Transition counts of the k-means labels, +1 smoothing
+            np.add.at(transitions, (np.arange(x.shape[0])[:, None], labels[:, :-1], labels[:, 1:]), 1)
+            return np.full((x.shape[0], K), 1 / K), transitions / transitions.sum(axis=2, keepdims=True), means, variances
+
+        def log_emissions(self, x, means, variances):   # Gaussian log-density of every frame in every state, (traces, frames, states)
+            return -0.5 * (np.log(2 * np.pi * variances)[:, None, :] + (x[:, :, None] - means[:, None, :]) ** 2 / variances[:, None, :])
+
+        def forward(self, log_b, log_pi, log_A):    # Forward variables and log-likelihood of every trace
+            log_alpha = np.empty_like(log_b)
+            log_alpha[:, 0] = log_pi + log_b[:, 0]
+            for t in range(1, log_b.shape[1]):  # np.logaddexp.reduce is the cheapest stable log-sum over the few states
+                log_alpha[:, t] = np.logaddexp.reduce(log_alpha[:, t - 1, :, None] + log_A, axis=1) + log_b[:, t]
+            return log_alpha, np.logaddexp.reduce(log_alpha[:, -1], axis=1)
+
+        def forward_backward(self, log_b, log_pi, log_A):
+            log_alpha, log_likelihood = self.forward(log_b, log_pi, log_A)
+            log_beta = np.zeros_like(log_b)
+            for t in range(log_b.shape[1] - 2, -1, -1):
+                log_beta[:, t] = np.logaddexp.reduce(log_A + (log_b[:, t + 1] + log_beta[:, t + 1])[:, None, :], axis=2)
+            return log_alpha, log_beta, log_likelihood
+
+        def fit_batch(self, x):                 # Baum-Welch on a batch of traces, returns the parameters and log-likelihood of every trace
+            startprob, transmat, means, variances = self.kmeans_init(x)
+            floor = self.min_covar * np.maximum(np.var(x, axis=1, keepdims=True), 1e-12)
+            variances = np.maximum(variances, floor)
+            log_likelihood = np.full(x.shape[0], -np.inf)
+            active = np.arange(x.shape[0])      # Traces that have not converged yet, only these are updated
+            for _ in range(self.n_iter):
+                xa = x[active]
+                log_A = np.log(np.maximum(transmat[active], 1e-300))
+                log_b = self.log_emissions(xa, means[active], variances[active])
+                log_alpha, log_beta, current = self.forward_backward(log_b, np.log(np.maximum(startprob[active], 1e-300)), log_A)
+
+                # E-step: state and transition posteriors
+                gamma = np.exp(log_alpha + log_beta - current[:, None, None])
+                xi = np.exp(log_alpha[:, :-1, :, None] + log_A[:, None] + (log_b + log_beta)[:, 1:, None, :] - current[:, None, None, None]).sum(axis=1)
+
+                # M-step
+                startprob[active] = gamma[:, 0]
+                transmat[active] = xi / np.maximum(xi.sum(axis=2, keepdims=True), 1e-300)
+                weights = np.maximum(gamma.sum(axis=1), 1e-300)
+                means[active] = (gamma * xa[:, :, None]).sum(axis=1) / weights
+                variances[active] = np.maximum((gamma * (xa[:, :, None] - means[active][:, None, :]) ** 2).sum(axis=1) / weights, floor[active])
+
+                improvement = current - log_likelihood[active]
+                log_likelihood[active] = current
+                active = active[improvement >= self.tol]
+                if active.size == 0:
+                    break
+            # current is the log-likelihood before the last M-step, the one of the returned parameters needs one more forward pass
+            log_likelihood = self.forward(self.log_emissions(x, means, variances), np.log(np.maximum(startprob, 1e-300)), np.log(np.maximum(transmat, 1e-300)))[1]
+            order = np.argsort(means, axis=1)   # State 0 is always the lowest intensity
+            rows = np.arange(x.shape[0])[:, None]
+            transmat = transmat[rows[:, :, None], order[:, :, None], order[:, None, :]]
+            return startprob[rows, order], transmat, means[rows, order], variances[rows, order], log_likelihood
+
+        def fit(self, traces):                  # Fit one HMM per trace, in batches of traces
+            x = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+            results = [self.fit_batch(x[start:start + self.batch_size]) for start in range(0, x.shape[0], self.batch_size)]
+            self.startprob_, self.transmat_, self.means_, self.vars_, self.log_likelihood_ = (np.concatenate(values) for values in zip(*results))
+            return self
+
+        def predict(self, traces):              # Viterbi path of every trace with its own fitted parameters
+            x = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+            n_traces, n_frames = x.shape
+            states = np.empty((n_traces, n_frames), dtype=int)
+            for start in range(0, n_traces, self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                log_b = self.log_emissions(x[batch], self.means_[batch], self.vars_[batch])
+                log_A = np.log(np.maximum(self.transmat_[batch], 1e-300))
+                delta = np.log(np.maximum(self.startprob_[batch], 1e-300)) + log_b[:, 0]
+                backpointers = np.empty(log_b.shape, dtype=np.int8)
+                for t in range(1, n_frames):
+                    scores = delta[:, :, None] + log_A                          # (traces, from, to)
+                    backpointers[:, t] = np.argmax(scores, axis=1)
+                    delta = np.max(scores, axis=1) + log_b[:, t]
+                path = np.empty((log_b.shape[0], n_frames), dtype=int)
+                path[:, -1] = np.argmax(delta, axis=1)
+                rows = np.arange(log_b.shape[0])
+                for t in range(n_frames - 1, 0, -1):
+                    path[:, t - 1] = backpointers[rows, t, path[:, t]]
+                states[batch] = path
+            return states
+
+        def score(self, traces):                # Log-likelihood of every trace
+            x = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+            log_likelihood = np.empty(x.shape[0])
+            for start in range(0, x.shape[0], self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                log_b = self.log_emissions(x[batch], self.means_[batch], self.vars_[batch])
+                log_likelihood[batch] = self.forward(log_b, np.log(np.maximum(self.startprob_[batch], 1e-300)), np.log(np.maximum(self.transmat_[batch], 1e-300)))[1]
+            return log_likelihood
+
+def compare_with_hmmlearn(traces, n_components=2, random_state=0):  # Agreement of the Viterbi paths with hmmlearn.GMMHMM on the same traces
+    from hmmlearn import hmm
+    traces = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+    fast_states = Gaussian_HMM(n_components).fit(traces).predict(traces)
+    agreement = np.empty(traces.shape[0])
+    for i, trace in enumerate(traces):
+        gm = hmm.GMMHMM(n_components=n_components, random_state=random_state)
+        gm.fit(trace.reshape(-1, 1))
+        states = gm.predict(trace.reshape(-1, 1))
+        order = np.argsort(np.argsort(gm.means_.ravel()))               # Relabel hmmlearn states by increasing mean, as Gaussian_HMM does
+        agreement[i] = np.mean(order[states] == fast_states[i])
+    return agreement                    # Fraction of frames with the same state, for every trace
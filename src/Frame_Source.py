@@ -0,0 +1,124 @@
+import numpy as np
+
+# Lazy access to the frames of a movie. Frames are read from the file only when they are requested and keep the
+# native dtype of the camera (uint16 for the EMCCD), so a 20000 frame movie never has to be held in memory at once.
+#
+#   source[i]                 -> one frame as a numpy array
+#   source[start:stop]        -> a lazy view of the frames start:stop (nothing is read)
+#   source[start:stop, x, y]  -> frames start:stop are read, then indexed with x, y
+#   np.asarray(source)        -> all the frames of the view as a numpy array
+#   source.chunks(500)        -> yields (start, frames) chunks of 500 frames
+
+class Frame_Source:
+        def __init__(self, n_frames, frame_shape, dtype, start=0):
+            self.start = start                                      # First frame of the view in the file
+            self.n_frames = n_frames
+            self.frame_shape = tuple(frame_shape)
+            self.dtype = np.dtype(dtype)
+
+        @property
+        def shape(self):
+            return (self.n_frames,) + self.frame_shape
+
+        @property
+        def ndim(self):
+            return len(self.shape)
+
+        @property
+        def nbytes(self):
+            return int(np.prod(self.shape)) * self.dtype.itemsize
+
+        def __len__(self):
+            return self.n_frames
+
+        def read(self, start, stop):                                # Read the frames start:stop of the file, implemented by the file readers
+            raise NotImplementedError
+
+        def view(self, start, n_frames):                            # New source sharing the same file, restricted to n_frames from start
+            view = object.__new__(type(self))
+            view.__dict__.update(self.__dict__)
+            view.start, view.n_frames = self.start + start, n_frames
+            return view
+
+        def __getitem__(self, key):
+            index, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+            if isinstance(index, slice) and not rest:               # Slicing the frames only creates a view, no data is read
+                start, stop, step = index.indices(self.n_frames)
+                if step == 1:
+                    return self.view(start, max(stop - start, 0))
+            if isinstance(index, (int, np.integer)):
+                if index < 0:
+                    index += self.n_frames
+                if not 0 <= index < self.n_frames:
+                    raise IndexError(f"Frame {index} is out of range for {self.n_frames} frames")
+                frames = self.read(self.start + index, self.start + index + 1)[0]
+                return frames[rest] if rest else frames
+            elif isinstance(index, slice):
+                start, stop, step = index.indices(self.n_frames)
+                frames = self.read(self.start + start, self.start + max(stop, start))[::step]
+            else:                                                   # Any other index: read the covered frames, then index them
+                index = np.arange(self.n_frames)[index]
+                first = int(index.min()) if index.size else 0
+                last = int(index.max()) + 1 if index.size else 0
+                frames = self.read(self.start + first, self.start + last)[index - first]
+            return frames[(slice(None),) + rest] if rest else frames    # Keep the frame axis first, as numpy does for data[start:stop, x, y]
+
+        def __array__(self, dtype=None, copy=None):
+            frames = self.read(self.start, self.start + self.n_frames)
+            return frames if dtype is None else frames.astype(dtype)
+
+        def chunks(self, chunk_size):                               # Yield (start, frames) for consecutive chunks of chunk_size frames
+            for start in range(0, self.n_frames, chunk_size):
+                stop = min(start + chunk_size, self.n_frames)
+                yield start, self.read(self.start + start, self.start + stop)
+
+        def close(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+class ND2_Source(Frame_Source):                                     # Nikon ND2 file read through the dask array of the nd2 package
+        def __init__(self, path):
+            import nd2
+            self.file = nd2.ND2File(path)
+            self.frames = self.file.to_dask()                       # Memory mapped chunks, read on compute()
+            super().__init__(self.frames.shape[0], self.frames.shape[1:], self.frames.dtype)
+
+        def read(self, start, stop):
+            return np.asarray(self.frames[start:stop].compute())
+
+        def close(self):
+            self.file.close()
+
+class TIF_Source(Frame_Source):                                     # TIF stack, memory mapped when the file allows it, otherwise read page by page
+        def __init__(self, path):
+            import tifffile as tiff
+            self.file = tiff.TiffFile(path)
+            series = self.file.series[0]
+            try:
+                self.frames = tiff.memmap(path, mode='r')           # Uncompressed contiguous files are mapped directly
+            except ValueError:
+                self.frames = None
+            if len(series.shape) == 2:                              # A single image is a movie of one frame
+                shape = (1,) + tuple(series.shape)
+                if self.frames is not None:
+                    self.frames = self.frames[None]
+            else:
+                shape = series.shape
+            super().__init__(shape[0], shape[1:], series.dtype)
+
+        def read(self, start, stop):
+            if self.frames is not None:
+                return np.array(self.frames[start:stop])            # Copy out of the map so the file can be closed
+            if stop <= start:
+                return np.zeros((0,) + self.frame_shape, dtype=self.dtype)
+            frames = self.file.asarray(key=range(start, stop))      # One page per frame
+            return frames.reshape((stop - start,) + self.frame_shape)
+
+        def close(self):
+            self.frames = None
+            self.file.close()
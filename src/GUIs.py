@@ -1,19 +1,26 @@
 import tkinter as tk
 from tkinterdnd2 import TkinterDnD, DND_FILES
 import os
-from BBM_Functions import BBM_Class
+import time
+import queue
+import threading
+import multiprocessing
+from BBM_Functions import BBM_Class, preload_modules
 BBM = BBM_Class()                       # Create an instance of the class
+from Pipeline import data_optimization, create_results_folders, get_positions, extract_traces, classify_traces, process_traces, stage_key
+from Results_Store import Results_Store
+from Trace_Plots import Plot_Renderer
+from Stage_Cache import Stage_Cache, Classification_Checkpoint, DEFAULT_FOLDER
 from tkinter import messagebox
 from tkinter import ttk
 import sys                              # Import sys to allow us to call sys.exit()
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from sklearn.exceptions import ConvergenceWarning
-import warnings
-
-# (GUI) Get file path and folder path from the user using a drag-and-drop interface
-def get_file_and_folder_path():
+
+# The whole workflow of one movie is run_analysis(), called by Main.py in its analysis worker or by running this file.
+# matplotlib, cv2, sep, hmmlearn and sklearn are imported by the stages that use them (see BBM_Functions.preload_modules),
+# so the first window opens before they are loaded.
+
+# (GUI) Get file path and folder path from the user using a drag-and-drop interface. started is the time.time() of the click on Start
+def get_file_and_folder_path(started=None):
     
     def drop(event):                            # Function to handle the drop event
         file_path = event.data.strip('{}')      # Remove curly braces from the path if they exist
@@ -34,28 +41,30 @@ def get_file_and_folder_path():
     label.pack(fill=tk.BOTH, expand=True)
     label.drop_target_register(DND_FILES)       # Register the label as a drop target for files
     label.dnd_bind('<<Drop>>', drop)            # Bind the drop event to the function
+    if started is not None:                     # Startup time, from the click on Start to the first window drawn
+        DnD.update_idletasks()
+        print(f"First window shown {time.time() - started:.2f} s after Start")
     DnD.mainloop()                              # Start the TkinterDnD main loop
 
     return file_path_var.get(), folder_path_var.get() # Return both the file and folder paths after the window closes
-# Call the function and retrieve the file and folder paths
-file_path, folder_path = get_file_and_folder_path()
-data, shape = BBM.import_data(file_path)    # Import the data in nd2 or tif formats
 
 # (GUI) Get user input
 def get_user_input(shape):                  # Function to get user input for frame interval and number of frames
     input = tk.Tk()                         # Create a window
     input.title("Parameters Input")
-    input.geometry('300x400')               # Set window size
+    input.geometry('300x520')               # Set window size
     frame_interval_var = tk.IntVar(value=11)# Default value 11
     n_frames_var = tk.IntVar(value=shape[0])# Default value is the data shape
     pre_amp_var = tk.DoubleVar(value=5.1)   # Default value 5.1
     em_gain_var = tk.DoubleVar(value=285)   # Default value 285
     wavelength_var = tk.DoubleVar(value=677)# Default value 677
+    cache_var = tk.BooleanVar(value=False)  # The stage cache is off by default, as in Batch.py
+    cache_size_var = tk.DoubleVar(value=2)  # Default value 2 GB
 
     def continue_button():                                                      # Function to handle the "Continue" button
         # Get the input values
         frame_interval, n_frames, pre_amp, em_gain, wavelength = frame_interval_var.get(), n_frames_var.get(), pre_amp_var.get(), em_gain_var.get(), wavelength_var.get()
-        if frame_interval <= 0 or n_frames <= 0:                                # Check if the values are valid
+        if frame_interval <= 0 or n_frames <= 0 or (cache_var.get() and cache_size_var.get() <= 0):  # Check if the values are valid
             messagebox.showerror("Invalid Input", "Please enter positive numbers.")
         else:                                                                   # Destroy the window and return the input values
             input.quit()                                                        # This will exit the event loop but keep the window open for possible input retrieval
@@ -92,6 +101,13 @@ def get_user_input(shape):                  # Function to get user input for fra
     label_wavelength = tk.Entry(input, textvariable=wavelength_var)
     label_wavelength.pack(pady=5)
 
+    check_cache = tk.Checkbutton(input, text="Keep the stage results for a rerun", variable=cache_var)
+    check_cache.pack(pady=5)
+    label_cache = tk.Label(input, text=f"Cache size in GB, in {DEFAULT_FOLDER}:", wraplength=280)
+    label_cache.pack(pady=5)
+    entry_cache = tk.Entry(input, textvariable=cache_size_var)
+    entry_cache.pack(pady=5)
+
     # Create "Continue" and "Close" buttons
     button_continue = tk.Button(input, text="Continue", command=continue_button)
     button_continue.pack(pady=10)
@@ -102,44 +118,41 @@ def get_user_input(shape):                  # Function to get user input for fra
     input.mainloop()
 
     # Return user inputs
-    return frame_interval_var.get(), n_frames_var.get(), pre_amp_var.get(), em_gain_var.get(), wavelength_var.get()
-frame_interval, n_frames, pre_amplifier_gain, em_gain, wavelength = get_user_input(shape)
-
-data = data [0:n_frames]           # Crop out corrupted data
-data_full = data                   # Save the full data for later use
-
-# Prepare data for the h analysis
-def data_optimization(data, shape, n_frames=4000): # Function to optimize the data for the h analysis
-    if shape[0] >= n_frames:
-        data = data[0:n_frames-1]           # Crop the data to the specified number of frames
-        shape = data.shape
-    elif shape[0] <= n_frames:              # Process the original data if it has fewer frames than n_frames
-        pass
-    # Background removal and normalization
-    data = BBM.data_normalization(np.array([BBM.background_removal(data[i]) for i in range(data.shape[0])]))
-    max_frame = BBM.max_frame(data)
-    return data, shape, max_frame
-data, shape, max_frame = data_optimization(data, shape, n_frames)
+    return frame_interval_var.get(), n_frames_var.get(), pre_amp_var.get(), em_gain_var.get(), wavelength_var.get(), cache_size_var.get() if cache_var.get() else None
 
 # (GUI) Get the h value from the user using a slider
 def get_h(max_frame):
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
     max_frame = BBM.data_normalization(max_frame)   # Normalize the max frame
 
-    def on_slider_move(value):
+    # Local maxima of the projection are found once, moving the slider only compares their values with the threshold
+    candidates, candidate_values = BBM.maxima_candidates(max_frame, 5)
 
-        # Update the slider and the particles positions
+    def on_slider_move(value):
+        # Update the slider value at once, redraw only when the slider stops for 100 ms
         gather_h.h = float(value)                   # Convert the slider value to a float
-        maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = BBM.locate_maxima(max_frame, gather_h.h, 5)
+        if on_slider_move.pending is not None:
+            gather_h.after_cancel(on_slider_move.pending)
+        on_slider_move.pending = gather_h.after(100, update_preview)
 
-        # Plot the images with the maxima locations
-        fig, ax = BBM.plot_images(max_frame,  maxima=maxima_locations_arr_joined, normalize = False, cmap = 'gray', axis = False, title=f"Detected {maxima_locations_quantity} particles.", lable="Maximum Count Recived per Pixel")
+    def update_preview():
+        on_slider_move.pending = None
+        maxima_locations_arr_joined = BBM.threshold_candidates(candidates, candidate_values, gather_h.h)
+        maxima_locations_quantity = len(maxima_locations_arr_joined)
+
+        # Move the circles of the single scatter plot and redraw the existing canvas
+        particles.set_offsets(maxima_locations_arr_joined[:, ::-1])     # Scatter uses (x, y) = (column, row)
+        particles.set_sizes([marker_size()])
+        ax.set_title(f"Detected {maxima_locations_quantity} particles.")
+        canvas.draw_idle()
 
-        # Replace the figure on the existing canvas
-        on_slider_move.canvas.figure = fig
-        on_slider_move.canvas.draw()
-        
         print(f"Slider value: {gather_h.h}")
 
+    def marker_size():     # Scatter size (points^2) of a circle with a radius of 5 pixels, as in plot_images
+        width_points = ax.get_window_extent().width * 72 / fig.dpi
+        return (2 * 5 * width_points / max_frame.shape[1]) ** 2
+
     def on_continue():     # Function to close the window
         plt.close('all')   # Close all figures
         gather_h.quit()    # This method tells the Tkinter main loop to exit
@@ -153,6 +166,8 @@ def get_h(max_frame):
 
     # Create the main window
     gather_h = tk.Tk()
+    gather_h.h = 0.2                                        # Default value, updated by the slider
+    on_slider_move.pending = None                           # Scheduled preview update of the slider
     gather_h.title("Select Threshold to Locate Particles")  # Set the window title
     gather_h.geometry("600x700")                            # Set the window size
 
@@ -190,157 +205,220 @@ def get_h(max_frame):
     )
     continue_button.pack(pady=5)
 
-    # Plot the initial figure (before any slider movement)
+    # Plot the figure once, the slider only updates the particles scatter and the title
     fig, ax = BBM.plot_images(max_frame, maxima=[], normalize=False, cmap = 'gray', axis=False, title="Maximum Projection", lable="Maximum Count Recived per Pixel")
+    ax.autoscale(False)                                     # Keep the image limits when the scatter changes
+    particles = ax.scatter([], [], s=[], facecolors='none', edgecolors='red')
 
     # Initialize the canvas and pack it in the middle frame
     canvas = FigureCanvasTkAgg(fig, master=middle_frame)
     canvas.draw()
     canvas.get_tk_widget().pack(fill='both', expand=True)
-    on_slider_move.canvas = canvas  # Assign the canvas to the slider move handler
 
     # Start the Tkinter event loop
     gather_h.mainloop()
 
     return gather_h.h
-h = get_h(max_frame)
-
-# Create results folder where all the results will be saved, use the folder path parameter and use the file name to create a folser
-results_path = f"{folder_path}/{os.path.splitext(os.path.basename(file_path))[0]}_Results"
-if not os.path.exists(results_path): # Check if the folder already exists
-    os.makedirs(results_path)        # Create the folder if it doesn't exist
-
-# Create a folder to save the traces
-def get_positions(data, h):
-    # Locate maxima in the data
-    maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = BBM.locate_maxima(data, h, 5)
-    # print (f'Maxima locations collected from {0} frame; Quantity: {len(maxima_locations_arr[0])}')
-    # print (f'Maxima locations collected from all {shape[0]} frames; Resulting in average of {int(maxima_locations_quantity/shape[0])} maxima per frame')
-
-    # Show 2-dimensional histogram and data with maxima locations
-    histogram_2d = BBM.histogram_2d_gradient(shape, maxima_locations_arr_joined)
-    maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = BBM.locate_maxima(histogram_2d, 4, 5)
-    maxima_locations_arr_joined = np.array(maxima_locations_arr_joined)                             # Save the maxima locations in txt file
-
-    # Create and save the figures
-    fig1, ax1 = BBM.plot_images(histogram_2d, maxima=maxima_locations_arr_joined, title='Two-Dimmentional Histogram', normalize=False, cmap='gray', lable="Particle occurrence (factor of 3)")  # Plot the first image (2D histogram)
-    fig1.savefig(f"{results_path}/2d_histogram.png")                                                # Save the figure to the specified path
-    np.savetxt(f"{results_path}/2d_histogram.txt", histogram_2d)                                    # Save the histogram in txt file
-    fig2, ax2 = BBM.plot_images(max_frame, cmap='gray', title="Maximum Projection", lable="Normalized Counts Recived per Pixel")  # Plot the second image (max frame)
-    ax2.set_title('Maximum Projection')
-    fig2.savefig(f"{results_path}/Maximum Projection.png")                                          # Save the figure to the specified path
-    np.savetxt(f"{results_path}/Maximum Projection.txt", max_frame)                                 # Save the max frame in txt file
-
-    # Close the figures
-    plt.close(fig1)
-    plt.close(fig2)
-    
-    # Save the maxima locations in txt file
-    trace_numbers = np.arange(maxima_locations_arr_joined.shape[0]).reshape(-1, 1)      # Create an array with trace numbers
-    new_array = np.hstack((trace_numbers, maxima_locations_arr_joined))                 # Combine the trace numbers with the maxima locations
-    header = 'Trace Number, y, x'                                                       # Create a header for the txt file
-    np.savetxt(f"{results_path}/Particles_Positions.txt", new_array, header=header, comments='', delimiter=',')   
-
-    # Return the maxima locations
-    return maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity  
-maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = get_positions(data, h) # Get the positions of the particles
-del data        # Remove the data to free up memory
-
-# Create a folders to save the traces
-positive_path = f"{results_path}/Positive"
-if not os.path.exists(positive_path):  # Check if the folder already exists
-    os.makedirs(positive_path)         # Create the folder if it doesn't exist
-
-false_positive_path = f"{results_path}/False_Positive"
-if not os.path.exists(false_positive_path):  # Check if the folder already exists
-    os.makedirs(false_positive_path)         # Create the folder if it doesn't exist
-
-# (GUI feedback) Analyse the traces: Remove traces that don't show photobleaching
-emissions = BBM.extract_intensities_max(data_full, maxima_locations_arr_joined, maxima_locations_quantity, frame_interval) # Gather emissions from the data
-
-def progress_analysis (emissions, maxima_locations_quantity, positive_path, false_positive_path):
+
+# Worker thread of the "Trace Processing" window: extracts the traces, classifies and saves them, and reports through the messages queue.
+# resume is cleared while paused, cancel stops after the current trace. The results of the traces done are always saved:
+# Results.npz with the traces classified so far (0 states for the others) and the checkpoint the next run resumes from
+def trace_worker(prepare, maxima_locations_quantity, positive_path, false_positive_path, store, plots, trace_workers, messages, cancel, resume):
+    results = None
+    try:
+        messages.put(('status', "Extracting the traces..."))
+        traces, checkpoint = prepare()
+        messages.put(('start', int(checkpoint.done.sum()) if checkpoint is not None else 0))    # Traces of the checkpoint come back at once, they are left out of the throughput
+        results = classify_traces(traces, maxima_locations_quantity, workers=trace_workers, checkpoint=checkpoint, mp_context=multiprocessing.get_context('spawn'))
+        for done, (i, *classification) in enumerate(results, start=1):
+            process_traces(traces, i, positive_path, false_positive_path, classification=classification, store=store, plots=plots)
+            messages.put(('trace', done, i))
+            resume.wait()                                       # Paused: no new trace is classified, the workers stop after their chunk
+            if cancel.is_set():
+                break
+    except Exception as e:
+        messages.put(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        try:                                                    # Every step is tried, an error is shown and the window is always released
+            if results is not None:
+                try:
+                    results.close()                             # Flushes the checkpoint and stops the process pool
+                except Exception as e:
+                    messages.put(('error', f"Stopping the classification: {type(e).__name__}: {e}"))
+            messages.put(('status', "Saving the results..."))
+            try:
+                store.save()                                    # All the results in one Results.npz next to the txt files
+            except Exception as e:
+                messages.put(('error', f"Saving the results: {type(e).__name__}: {e}"))
+            messages.put(('status', "Saving the figures..."))
+            try:
+                plots.close()                                   # Wait for the trace figures drawn in the background
+            except Exception as e:
+                messages.put(('error', f"Drawing the figures: {type(e).__name__}: {e}"))
+        finally:
+            messages.put(('finished', cancel.is_set()))
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes // 60}:{minutes % 60:02d}:{seconds:02d}" if minutes >= 60 else f"{minutes}:{seconds:02d}"
+
+# (GUI feedback) Progress of the traces. The analysis runs in trace_worker, the window polls its queue every 100 ms so it never freezes
+def progress_analysis (prepare, maxima_locations_quantity, positive_path, false_positive_path, store, plots, trace_workers):
     # Create the main window
     root = tk.Tk()
     root.title("Trace Processing")
     
     # Set window size
-    root.geometry("400x200")
+    root.geometry("400x250")
     
     # Create a label to show the status of processing
     status_label = tk.Label(root, text="Loading...")
-    status_label.pack(pady=20)
+    status_label.pack(pady=(20, 5))
+    rate_label = tk.Label(root, text="")                # Throughput and estimated time left
+    rate_label.pack(pady=5)
 
     # Create a progress bar
     progress = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
-    progress.pack(pady=20)
+    progress.pack(pady=10)
 
     # Set the progress bar's maximum value
-    progress['maximum'] = maxima_locations_quantity - 1
+    progress['maximum'] = max(maxima_locations_quantity, 1)
+
+    messages, cancel, resume = queue.Queue(), threading.Event(), threading.Event()
+    resume.set()
+    state = {'done': 0, 'restored': None, 'started': None, 'paused_at': None, 'paused': 0.0, 'finished': False, 'closing': False}
+
+    def pause_button():
+        if resume.is_set():
+            resume.clear()
+            state['paused_at'] = time.monotonic()
+            button_pause.config(text="Resume")
+            status_label.config(text=f"Paused after trace {state['done']} out of {maxima_locations_quantity}")
+        else:
+            state['paused'] += time.monotonic() - state['paused_at']
+            resume.set()
+            button_pause.config(text="Pause")
+
+    def cancel_button():
+        if state['finished']:
+            root.destroy()
+            return
+        cancel.set()
+        resume.set()                                    # A paused worker has to wake up to stop
+        button_pause.config(state='disabled')
+        button_cancel.config(state='disabled')
+        status_label.config(text="Stopping after the current trace...")
+
+    def show_rate():                                    # Traces per second without the pauses and the traces of the checkpoint
+        if state['started'] is None or state['done'] <= state['restored']:
+            return
+        elapsed = time.monotonic() - state['started'] - state['paused']
+        rate = (state['done'] - state['restored']) / max(elapsed, 1e-9)
+        left = maxima_locations_quantity - state['done']
+        rate_label.config(text=f"{rate:.2f} traces/s, {format_seconds(elapsed)} elapsed, about {format_seconds(left / rate)} left")
+
+    def poll():                                         # Read every message of the worker, then update the window once
+        try:
+            while True:
+                message = messages.get_nowait()
+                if message[0] == 'status':
+                    status_label.config(text=message[1])
+                elif message[0] == 'start':
+                    state['restored'], state['started'] = message[1], time.monotonic()
+                elif message[0] == 'trace':
+                    state['done'] = message[1]
+                    if resume.is_set() and not cancel.is_set():
+                        status_label.config(text=f"Processing trace {state['done']} out of {maxima_locations_quantity}")
+                elif message[0] == 'error':
+                    messagebox.showerror("Analysis stopped", message[1])
+                elif message[0] == 'finished':
+                    state['finished'] = True
+        except queue.Empty:
+            pass
+        progress['value'] = state['done']               # Update the progress bar
+        if resume.is_set():
+            show_rate()
+        if state['finished']:                           # Completion message after the worker finished
+            if cancel.is_set():
+                status_label.config(text=f"Stopped, {state['done']} out of {maxima_locations_quantity} traces saved")
+            else:
+                status_label.config(text="Processing complete!")
+            button_pause.config(state='disabled')
+            button_cancel.config(text="Close", state='normal')
+            if state['closing']:
+                root.destroy()
+            return
+        root.after(100, poll)
+
+    def on_close():                                     # Closing the window stops the analysis, the window closes once the work done is saved
+        state['closing'] = True
+        if state['finished']:
+            root.destroy()
+        elif not cancel.is_set():
+            cancel_button()
+
+    buttons = tk.Frame(root)
+    buttons.pack(pady=10)
+    button_pause = tk.Button(buttons, text="Pause", width=10, command=pause_button)
+    button_pause.pack(side='left', padx=10)
+    button_cancel = tk.Button(buttons, text="Cancel", width=10, command=cancel_button)
+    button_cancel.pack(side='left', padx=10)
+    root.protocol("WM_DELETE_WINDOW", on_close)
+
+    # The HMM classification runs in a process pool started by the worker thread, the traces are saved as they come back
+    threading.Thread(target=trace_worker, args=(prepare, maxima_locations_quantity, positive_path, false_positive_path, store, plots, trace_workers,
+                                                messages, cancel, resume), daemon=True).start()
+    root.after(100, poll)
+
+    # Start the Tkinter main loop
+    root.mainloop()
 
-    # Start processing traces (simulating a loop with real data)
-    for i in range(maxima_locations_quantity):
-        status_label.config(text=f"Processing trace {i} out of {maxima_locations_quantity}")
-        progress['value'] = i       # Update the progress bar
+# Whole analysis of one movie: drag and drop, parameters, threshold, then the classification of the traces
+def run_analysis(started=None):
+    threading.Thread(target=preload_modules, daemon=True).start()   # Import the analysis modules while the user picks the file, nothing to do when they are loaded
 
-        process_traces(emissions, i, positive_path, false_positive_path)
+    # Call the function and retrieve the file and folder paths
+    file_path, folder_path = get_file_and_folder_path(started)
+    data, shape = BBM.import_data(file_path)    # Import the data in nd2 or tif formats
 
-        root.update_idletasks()     # Update the GUI with current progress
+    frame_interval, n_frames, pre_amplifier_gain, em_gain, wavelength, cache_size_gb = get_user_input(shape)
 
-    # Completion message after loop finishes
-    status_label.config(text="Processing complete!")
-    progress['value'] = maxima_locations_quantity - 1  # Ensure the progress bar is full
+    data = data [0:n_frames]           # Crop out corrupted data
+    data_full = data                   # Save the full data for later use
 
-    # Start the Tkinter main loop
-    root.mainloop()
+    # With the cache checked, the results of the stages are kept in ~/.bbm_cache (at most cache_size_gb), a rerun of the same movie only recomputes the stages after the first changed parameter
+    cache = Stage_Cache(DEFAULT_FOLDER, int(cache_size_gb * 1024**3)) if cache_size_gb else None
+    data_key = stage_key(cache, 'data_optimization', cache.file_key(file_path) if cache else None, n_frames=n_frames, temporal_step=None)
 
-def process_traces(emissions, i, positive_path, false_positive_path):
+    # Prepare data for the h analysis
+    data, shape, max_frame = data_optimization(data, shape, n_frames, cache=cache, cache_key=data_key)
 
-    number_of_states = 1
-    for guess_state in range(2, 3):    
-        states = BBM.states_assignment(guess_state, emissions, int(i))              # Assign states to the emissions      
-        warnings.filterwarnings("ignore", category=ConvergenceWarning)              # Suppress specific warnings if needed           
-        silhouette_avg = BBM.calculate_silhouette(emissions, states, int(i))        # Calculate silhouette coefficient
-        if silhouette_avg > 0.65:
-            number_of_states = guess_state                                          # Update the number of states if silhouette coefficient is above threshold
-            break
-    states = BBM.states_assignment(number_of_states, emissions, int(i))             # Fit HMM with the optimal number of states
+    h = get_h(max_frame)
 
-    print(f"Trace {i}: {number_of_states} states(s). Silhouette coefficient {round(silhouette_avg, 2)}/{0.65}.")
-    
-    if number_of_states >= 2:
-        mono, trace_path, trace_name = False, positive_path, f"Trace_{i}"
-    else:
-        mono, trace_path, trace_name = True, false_positive_path, f"Mono_Trace_{i}"
-
-    # COUNTS
-    # Plot the emissions and save the trace in a txt file
-    fig, ax =BBM.plot_emissions(emissions, int(i), states, mono=mono)
-    fig.savefig(f"{trace_path}/C_{trace_name}.png")  # C - stands for counts
-    plt.close()
-
-    # PHOTONS - R
-    # Count Convert
-    counts = emissions[i + 1].copy()                 # Copy the emissions to avoid modifying the original data
-    photons_received = BBM.count_convert(counts, pre_amplifier_gain = pre_amplifier_gain, em_gain = em_gain, wavelength = wavelength)
-    emissions[i + 1] = photons_received
-    # Plot the emissions and save the trace in a txt file
-    fig, ax =BBM.plot_emissions(emissions, int(i), states, mono=mono, lable_Oy="Photons Received")
-    fig.savefig(f"{trace_path}/PR_{trace_name}.png") # PR - stands for Photons Received
-    plt.close()
-
-    # PHOTONS - E
-    # Emitted Phototns
-    recorded_to_emitted = BBM.recorded_to_emitted(photons_received, wavelength = wavelength)
-    emissions[i + 1] = recorded_to_emitted
-    # Plot the emissions and save the trace in a txt file
-    fig, ax =BBM.plot_emissions(emissions, int(i), states, mono=mono, lable_Oy="Emitted Photons")
-    fig.savefig(f"{trace_path}/PE_{trace_name}.png") # PE - stands for Photons Emitted
-    plt.close()
-
-    # Save trace in txt file
-    trace = np.zeros((len(emissions[0]), 4))
-    trace[:, 0], trace[:, 1], trace[:, 2], trace[:, 3] = emissions[0], counts, photons_received, recorded_to_emitted
-    header = "Time_sec, EMCCD_Counts, Photons_Received_by_EMCCD, Emitted_Photons_ by_the_Sample" 
-    np.savetxt(f"{trace_path}/{trace_name}.txt", trace, header=header)
-
-progress_analysis(emissions, maxima_locations_quantity,  positive_path, false_positive_path)
\ No newline at end of file
+    # Create results folder where all the results will be saved, use the folder path parameter and use the file name to create a folser
+    results_path, positive_path, false_positive_path = create_results_folders(file_path, folder_path)
+    store = Results_Store(results_path, parameters={'frame_interval': frame_interval, 'n_frames': n_frames, 'pre_amp': pre_amplifier_gain, 'em_gain': em_gain, 'wavelength': wavelength, 'h': h})
+
+    positions_key = stage_key(cache, 'positions', data_key, h=h)
+    maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = get_positions(data, shape, h, max_frame, results_path, store, cache=cache, cache_key=positions_key,
+                                                                                                 recompute_data=lambda: data_optimization(data_full, data_full.shape, n_frames)[0]) # Get the positions of the particles
+    del data        # Remove the data to free up memory
+
+    # (GUI feedback) Analyse the traces: Remove traces that don't show photobleaching. The traces are extracted in the worker thread of the progress window
+    def prepare():
+        traces = extract_traces(data_full, maxima_locations_arr_joined, maxima_locations_quantity, frame_interval, cache=cache,
+                                cache_key=stage_key(cache, 'traces', positions_key, frame_interval=frame_interval)) # Gather the counts of every particle from the data
+        traces.set_conversion(pre_amplifier_gain, em_gain, wavelength) # The photons are converted trace by trace when they are needed
+        store.set_traces(traces)
+        checkpoint = Classification_Checkpoint(cache, stage_key(cache, 'classification', positions_key, backend='hmmlearn', selection='silhouette', silhouette_method='exact'),
+                                               maxima_locations_quantity, traces.n_frames) if cache else None  # A classification stopped before the end continues from here
+        return traces, checkpoint
+
+    trace_workers = os.cpu_count() or 1 # Number of processes used for the HMM classification of the traces
+    plots = Plot_Renderer('lazy', mp_context=multiprocessing.get_context('spawn'))  # The trace figures are drawn by a pool of processes while the traces are classified,
+                                                                                   # started from the worker thread: spawned, a fork would copy the Tk state
+
+    progress_analysis(prepare, maxima_locations_quantity,  positive_path, false_positive_path, store, plots, trace_workers)
+
+if __name__ == '__main__':
+    run_analysis()
@@ -0,0 +1,310 @@
+import os
+os.environ['MPLBACKEND'] = 'Agg'        # No display in watch mode. matplotlib and tifffile are imported when they are first needed
+import sys
+import glob
+import time
+import struct
+import argparse
+import threading
+import numpy as np
+import logging
+from BBM_Functions import BBM_Class, preload_modules
+from Fast_HMM import Gaussian_HMM
+BBM = BBM_Class()                       # Create an instance of the class
+
+# Live analysis of a movie while it is being acquired: a growing TIF stack or a folder where the camera writes one file per frame
+# is polled, and every new chunk of frames goes through background removal, maxima location and the 2-D histogram. The particles
+# are found again in the accumulated histogram every update_every frames: a peak within the locate box (5 pixels) of a known
+# particle is that particle, and a particle that is no longer a peak and did not bleach is dropped, so the particles follow the
+# histogram as the counts build up. Their traces are kept in ring buffers and a particle is reported as bleached as soon as its
+# trace shows a step (2-state HMM of Fast_HMM.py, silhouette coefficient above 0.65).
+#
+#   python Live.py /path/to/movie.tif --params params.json          # or a folder of frame files
+#   python Live.py /tmp/test.tif --simulate 2000                     # writes a synthetic movie frame by frame and watches it
+#
+# The normalization uses the range of the frames received so far instead of the range of the whole movie, so the threshold h
+# can select slightly different maxima than Batch.py. Live_Results.npz is written to the _Results folder when no new frame
+# arrived for --idle-timeout seconds. A growing TIF is reopened at every poll, but only the pages written since the last poll
+# are parsed.
+
+class Ring_Buffer:                      # Last capacity items of a stream, the oldest are overwritten
+        def __init__(self, capacity, item_shape=(), dtype=np.float64):
+            self.capacity = capacity
+            self.items = np.zeros((capacity,) + tuple(item_shape), dtype=dtype)
+            self.total = 0              # Items appended since the start
+
+        def __len__(self):
+            return min(self.total, self.capacity)
+
+        @property
+        def first(self):                # Stream index of the oldest item kept
+            return self.total - len(self)
+
+        def append(self, items):        # items: (n, *item_shape)
+            items = items[-self.capacity:]
+            positions = (self.total + np.arange(len(items))) % self.capacity
+            self.items[positions] = items
+            self.total += len(items)
+
+        def select(self, columns):      # Keep only these columns of items of shape (k,)
+            self.items = self.items[:, columns]
+
+        def array(self):                # Items kept, oldest first
+            if self.total <= self.capacity:
+                return self.items[:self.total]
+            return np.roll(self.items, -(self.total % self.capacity), axis=0)
+
+        def widen(self, columns):       # Add columns to items of shape (k,), columns: (len(self), n) aligned with array()
+            items = np.zeros((self.capacity, self.items.shape[1] + columns.shape[1]), dtype=self.items.dtype)
+            items[:, :self.items.shape[1]] = self.items
+            positions = (self.first + np.arange(len(self))) % self.capacity
+            items[positions, self.items.shape[1]:] = columns
+            self.items = items
+
+class Live_Analysis:
+        def __init__(self, h=0.2, frame_interval=11, box=5, update_every=100, buffer_frames=2000, history_frames=500, min_dwell=10,
+                     silhouette_threshold=0.65, merge_distance=None):
+            self.h, self.frame_interval, self.box = h, frame_interval, box
+            self.update_every = update_every                # Frames between two searches for particles and steps
+            self.buffer_frames = buffer_frames              # Frames of every trace kept for the step detection
+            self.history_frames = history_frames            # Raw frames kept to fill the beginning of the traces of newly found particles
+            self.min_dwell = min_dwell                      # Frames after a step before it is reported, so a short dip is not a bleach
+            self.silhouette_threshold = silhouette_threshold
+            self.merge_distance = box if merge_distance is None else merge_distance    # Peaks within this box (pixels, as the box of locate_maxima) of a known particle are that particle, the peaks drift as the counts build up
+            self.n_frames = 0
+            self.counts = None                              # Count image of the maxima, the histogram is its gradient
+            self.data_min, self.data_max = np.inf, -np.inf  # Range of the background subtracted frames received so far
+            self.max_projection = None
+            self.positions = np.zeros((0, 2), dtype=np.int64)
+            self.bleach_frame = np.zeros(0, dtype=np.int64) # -1 until the particle bleaches
+            self.frames = None
+            self.traces = None
+            self.last_update = 0
+
+        def add_frames(self, frames):   # Process a chunk of raw frames (n, height, width), returns the particles that bleached
+            frames = np.asarray(frames)
+            if frames.ndim == 2:
+                frames = frames[None]
+            if self.frames is None:
+                self.frames = Ring_Buffer(self.history_frames, frames.shape[1:], frames.dtype)
+                self.traces = Ring_Buffer(self.buffer_frames, (0,))
+                self.counts = np.zeros(frames.shape[1:])
+            subtracted = BBM.background_removal_batch(frames)
+            self.data_min, self.data_max = min(self.data_min, np.min(subtracted)), max(self.data_max, np.max(subtracted))
+            chunk_max = np.max(subtracted, axis=0)
+            self.max_projection = chunk_max if self.max_projection is None else np.maximum(self.max_projection, chunk_max)
+            normalized = (subtracted - self.data_min) / max(self.data_max - self.data_min, 1e-12)
+            self.counts += BBM.maxima_counts(frames.shape, BBM.locate_maxima_batch(normalized, self.h, self.box, verbose=False))
+
+            self.frames.append(frames)
+            self.traces.append(self.intensities(frames, self.positions))
+            self.n_frames += len(frames)
+            if self.n_frames - self.last_update >= self.update_every:
+                return self.update()
+            return []
+
+        def intensities(self, frames, positions):   # Maximum of the 6x6 box around every particle, as extract_intensities_max
+            return BBM.extract_counts(frames, positions, len(positions), box=3).T
+
+        def histogram_2d(self):
+            return BBM.counts_gradient(self.counts)
+
+        def find_particles(self):       # Particles of the accumulated histogram: known ones are kept, new ones start with the raw frames kept
+            candidates, values = BBM.maxima_candidates(self.histogram_2d(), self.box)
+            peaks = BBM.threshold_candidates(candidates, values, 4)
+            # Particles that did not bleach and are not a peak of the histogram anymore were noise of the first frames, they are dropped
+            if len(self.positions):
+                near_peak = np.array([len(peaks) > 0 and np.abs(peaks - position).max(axis=1).min() <= self.merge_distance for position in self.positions], dtype=bool)
+                keep = near_peak | (self.bleach_frame >= 0)
+                if not keep.all():
+                    print(f"Frame {self.n_frames}: {np.sum(~keep)} particle(s) dropped, not a peak of the histogram anymore")
+                    self.positions, self.bleach_frame = self.positions[keep], self.bleach_frame[keep]
+                    self.traces.select(keep)
+            found = []
+            for peak in peaks:              # Highest first, a peak within merge_distance of a kept one is the same particle
+                known = np.vstack([self.positions] + found) if found else self.positions
+                if len(known) == 0 or np.abs(known - peak).max(axis=1).min() > self.merge_distance:
+                    found.append(peak[None])
+            if len(found) == 0:
+                return
+            found = np.vstack(found)
+            history = self.frames.array()[-len(self.traces):]           # Raw frames of the trace buffer that are still kept
+            columns = np.zeros((len(self.traces), len(found)))
+            if len(history):
+                columns[-len(history):] = self.intensities(history, found)
+                columns[:-len(history)] = columns[-len(history)]              # Frames older than the raw history repeat the first known value
+            self.traces.widen(columns)
+            self.positions = np.vstack((self.positions, found))
+            self.bleach_frame = np.concatenate((self.bleach_frame, np.full(len(found), -1)))
+            print(f"Frame {self.n_frames}: {len(found)} new particle(s), {len(self.positions)} in total")
+
+        def detect_steps(self):         # Fit the traces of the particles that did not bleach yet, returns the particles that bleached
+            active = np.where(self.bleach_frame < 0)[0]
+            if len(active) == 0 or len(self.traces) < 2 * self.min_dwell:
+                return []
+            traces = self.traces.array()[:, active].T
+            states = Gaussian_HMM(2).fit(traces).predict(traces)       # State 0 is the lowest intensity
+            bleached = []
+            for j, i in enumerate(active):
+                changes = np.where(np.diff(states[j]) != 0)[0]
+                if changes.size == 0:
+                    continue
+                last_change = changes[-1] + 1
+                if states[j, -1] != 0 or len(states[j]) - last_change < self.min_dwell:   # Still emitting, or the step is too recent
+                    continue
+                if BBM.silhouette_1d(traces[j], states[j]) > self.silhouette_threshold:
+                    self.bleach_frame[i] = self.traces.first + last_change
+                    bleached.append(i)
+            return bleached
+
+        def update(self):
+            self.last_update = self.n_frames
+            self.find_particles()
+            bleached = self.detect_steps()
+            for i in bleached:
+                print(f"Particle {i} at ({self.positions[i][0]}, {self.positions[i][1]}) bleached at frame {self.bleach_frame[i]} ({self.bleach_frame[i] * self.frame_interval / 1000:.2f} s)")
+            return bleached
+
+        def save(self, results_path):   # Positions, histogram, maximum projection, bleach frames and the traces kept
+            os.makedirs(results_path, exist_ok=True)
+            max_projection = (self.max_projection - self.data_min) / max(self.data_max - self.data_min, 1e-12)
+            path = os.path.join(results_path, "Live_Results.npz")
+            np.savez_compressed(path, positions=self.positions, histogram_2d=self.histogram_2d(), max_projection=max_projection, bleach_frame=self.bleach_frame,
+                                traces=self.traces.array().T, first_frame=self.traces.first, n_frames=self.n_frames, frame_interval=self.frame_interval)
+            print(f"Results saved to {path}")
+            return path
+
+class Growing_TIF:                      # TIF stack that is still being written, the last page is only read once the file stops growing
+        def __init__(self, path, settle=1.0):
+            logging.getLogger('tifffile').setLevel(logging.CRITICAL)   # Pages being written are reported as invalid, they are read at the next poll
+            self.path, self.settle = path, settle
+            self.n_read = 0
+            self.next_pointer = None    # File position of the "next IFD" offset of the last page read, the pages before it are never parsed again
+            self.size, self.size_time = -1, time.monotonic()
+
+        def new_pages(self, f, stable):     # IFD offsets of the pages written since the last poll, the last one only when the file is stable
+            fh, header = f.filehandle, f.tiff
+            if self.next_pointer is None:
+                if len(f.pages) == 0:   # Header written, first page not yet: no frames
+                    return [], None
+                offset = f.pages.first.offset
+            else:
+                fh.seek(self.next_pointer)
+                offset = struct.unpack(header.offsetformat, fh.read(header.offsetsize))[0]
+            offsets, pointer = [], self.next_pointer
+            while offset:
+                fh.seek(offset)
+                n_tags = struct.unpack(header.tagnoformat, fh.read(header.tagnosize))[0]
+                next_pointer = offset + header.tagnosize + n_tags * header.tagsize
+                fh.seek(next_pointer)
+                next_offset = struct.unpack(header.offsetformat, fh.read(header.offsetsize))[0]
+                if not next_offset and not stable:                      # The page being written may be incomplete
+                    break
+                offsets.append(offset)
+                offset, pointer = next_offset, next_pointer
+            return offsets, pointer
+
+        def poll(self):                 # New complete frames, or None
+            if not os.path.exists(self.path):
+                return None
+            size = os.path.getsize(self.path)
+            if size != self.size:
+                self.size, self.size_time = size, time.monotonic()
+            stable = time.monotonic() - self.size_time >= self.settle
+            import tifffile as tiff
+            try:
+                with tiff.TiffFile(self.path) as f:                     # Opening reads the header and the first page only
+                    offsets, pointer = self.new_pages(f, stable)
+                    if not offsets:
+                        return None
+                    frames = []
+                    for index, offset in enumerate(offsets, self.n_read):
+                        f.filehandle.seek(offset)
+                        frames.append(tiff.TiffPage(f, index).asarray())
+                    frames = np.stack(frames)
+            except (tiff.TiffFileError, ValueError, OSError, struct.error, IndexError):   # Read while the header or a page is being written, try again later
+                return None
+            self.n_read += len(frames)
+            self.next_pointer = pointer
+            return frames
+
+class Frame_Directory:                  # Folder where every new file holds one or more frames, a file is read once its size is stable
+        def __init__(self, folder, pattern="*.tif", settle=1.0):
+            self.folder, self.pattern, self.settle = folder, pattern, settle
+            self.read = set()
+            self.sizes = {}
+
+        def poll(self):
+            files = sorted(glob.glob(os.path.join(self.folder, self.pattern)))
+            ready = []
+            for position, path in enumerate(files):
+                if path in self.read:
+                    continue
+                size = os.path.getsize(path)
+                if self.sizes.get(path, (None,))[0] != size:
+                    self.sizes[path] = (size, time.monotonic())
+                newer_file = position < len(files) - 1                 # The camera moved on to the next file
+                if not newer_file and time.monotonic() - self.sizes[path][1] < self.settle:
+                    break                                               # Keep the frames in order
+                ready.append(path)
+            if not ready:
+                return None
+            self.read.update(ready)
+            import tifffile as tiff
+            frames = [tiff.imread(path) for path in ready]
+            return np.concatenate([frame.reshape((-1,) + frame.shape[-2:]) for frame in frames])
+
+def watch(source, live, poll_interval=0.5, idle_timeout=10):  # Feed the new frames of the source to the analysis until nothing arrives for idle_timeout seconds
+    last_frame_time = time.monotonic()
+    while time.monotonic() - last_frame_time < idle_timeout:
+        frames = source.poll()
+        if frames is None:
+            time.sleep(poll_interval)
+            continue
+        last_frame_time = time.monotonic()
+        live.add_frames(frames)
+    if live.n_frames > live.last_update:
+        live.update()                   # Last frames of the acquisition
+    return live
+
+def simulate_acquisition(movie, path, frame_interval=11, directory=False):  # Stand-in for the camera: writes the frames one by one at the frame rate
+    import tifffile as tiff
+    if directory:
+        os.makedirs(path, exist_ok=True)
+        for i, frame in enumerate(movie):
+            tiff.imwrite(os.path.join(path, f"frame_{i:06d}.tif"), frame)
+            time.sleep(frame_interval / 1000)
+        return
+    with open(path, 'wb') as f, tiff.TiffWriter(f) as writer:
+        for frame in movie:
+            writer.write(frame, contiguous=False, metadata=None)    # Every frame is a separate page, as a camera streaming to disk
+            f.flush()
+            time.sleep(frame_interval / 1000)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Live BBM analysis of a TIF stack or frame folder that is still being written")
+    parser.add_argument('path', help="Growing .tif stack or folder of frame files")
+    parser.add_argument('--params', default=None, help="JSON parameter file of Batch.py, h and frame_interval are used")
+    parser.add_argument('--update-every', type=int, default=100, help="Frames between two searches for particles and bleaching steps")
+    parser.add_argument('--idle-timeout', type=float, default=10, help="Seconds without new frames before the acquisition is considered finished")
+    parser.add_argument('--simulate', type=int, default=0, help="Write a synthetic movie of this many frames to path while watching it")
+    args = parser.parse_args(argv)
+    threading.Thread(target=preload_modules, daemon=True).start()   # Import the analysis modules while the first frames arrive
+
+    parameters = {'h': 0.2, 'frame_interval': 11}
+    if args.params:
+        from Batch import load_parameters
+        parameters = load_parameters(args.params)
+    directory = os.path.isdir(args.path) or os.path.splitext(args.path)[1] == ''
+    if args.simulate:
+        from benchmarks.Synthetic_Movie import synthetic_movie
+        movie, truth = synthetic_movie(n_frames=args.simulate)
+        print(f"Simulating {args.simulate} frames, true bleach frames: {sorted(truth['last_bleach'].tolist())}")
+        threading.Thread(target=simulate_acquisition, args=(movie, args.path, parameters['frame_interval'], directory), daemon=True).start()
+    source = Frame_Directory(args.path) if directory else Growing_TIF(args.path)
+    live = watch(source, Live_Analysis(parameters['h'], parameters['frame_interval'], update_every=args.update_every), idle_timeout=args.idle_timeout)
+    live.save(f"{os.path.splitext(os.path.normpath(args.path))[0]}_Results")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,109 @@
 import tkinter as tk
-import subprocess
+import multiprocessing
 import threading
-import os
-
-def start():
-    button_start.pack_forget()                                                      # Remove the buttons and display the message
-    button_close.pack_forget()
-    label_processing = tk.Label(root, text='Data Analysis in Process', bg='yellow') # Create a label to show that the process is ongoing
-    label_processing.pack(pady=20)
-
-    def run_analysis():                             # Run the subprocess in a separate thread to prevent blocking the GUI
-
-        # Get the path to the current script's directory
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # Construct the full path to GUIs.py
-        gui_script_path = os.path.join(current_dir, 'GUIs.py')
-
-        subprocess.run(['python', gui_script_path]) # Run the analysis script
-        label_processing.pack_forget()              # After the process completes, update the GUI (re-enable buttons)
-        button_start.pack(pady=20)
-        button_close.pack(pady=20)
-    threading.Thread(target=run_analysis).start()   # Start the process in a new thread
-
-def close():                                        # Close the window
-    print('Close')
-    root.destroy()
-
-root = tk.Tk()                                              # Create the main window
-root.title('Analysis Workflow')                             # Set the title of the window
-root.geometry('400x200')                                    # Set the window size to 400x200 pixels
-button_start = tk.Button(root, text='Start', command=start) # Create the "Start" button
-button_start.pack(pady=20)
-button_close = tk.Button(root, text='Close', command=close) # Create the "Close" button
-button_close.pack(pady=20)
-
-root.mainloop()                                             # Start the main loop of the window
\ No newline at end of file
+import traceback
+import queue
+import time
+import sys
+
+# Launcher window. The analysis (GUIs.run_analysis) runs in a worker process started with the launcher: it imports the
+# analysis modules while the launcher waits for Start and stays alive between analyses, so a click on Start only pays
+# for opening the first window instead of a fresh interpreter importing everything. When the worker exits (a window of
+# the analysis was closed with its Close button) a new one is started for the next analysis.
+#
+#   python Main.py                  # prints the import time of the worker and, for every analysis, the startup time:
+#                                   # "First window shown 0.08 s after Start"
+
+def analysis_worker(requests, events):      # Worker process: imports the analysis once, then runs one analysis per request
+    start = time.perf_counter()
+    try:
+        import GUIs
+        from BBM_Functions import preload_modules
+        preload_modules()
+    except Exception:
+        events.put(('failed', traceback.format_exc()))
+        return
+    events.put(('ready', time.perf_counter() - start))
+    for started in iter(requests.get, None):    # started is the time.time() of the click on Start, None stops the worker
+        try:
+            GUIs.run_analysis(started)
+        except SystemExit:                  # A window of the analysis was closed, the worker is kept for the next one
+            pass
+        except Exception:
+            traceback.print_exc()
+        events.put(('finished', time.time() - started))
+
+class Analysis_Worker:                      # Pre-warmed worker process of the launcher
+        def __init__(self):
+            self.context = multiprocessing.get_context('spawn')     # A fork of the launcher would share its Tk state
+            self.start()
+
+        def start(self):
+            self.requests, self.events = self.context.Queue(), self.context.Queue()
+            self.process = self.context.Process(target=analysis_worker, args=(self.requests, self.events))  # Not a daemon, the analysis starts its own process pools
+            self.process.start()
+
+        def run(self):                      # Run one analysis and wait for its end, called from a thread of the launcher. Returns False when the worker failed
+            if not self.process.is_alive():
+                self.start()
+            self.requests.put(time.time())
+            while True:
+                try:
+                    event, value = self.events.get(timeout=0.5)
+                except queue.Empty:
+                    if not self.process.is_alive():                 # sys.exit() or a crash in the worker, start a new one for the next analysis
+                        self.start()
+                        return False
+                    continue
+                if event == 'ready':
+                    print(f"Analysis modules imported in {value:.2f} s")
+                elif event == 'failed':
+                    print(f"The analysis could not be started:\n{value}")
+                    self.process.join()
+                    return False
+                elif event == 'finished':
+                    print(f"Analysis finished {value:.1f} s after Start")
+                    return True
+
+        def close(self):                    # The worker exits after the current analysis
+            if self.process.is_alive():
+                self.requests.put(None)
+
+def main():
+    worker = Analysis_Worker()
+
+    def start():
+        button_start.pack_forget()                                                      # Remove the buttons and display the message
+        button_close.pack_forget()
+        label_processing = tk.Label(root, text='Data Analysis in Process', bg='yellow') # Create a label to show that the process is ongoing
+        label_processing.pack(pady=20)
+
+        def run_analysis():                         # Wait for the worker in a separate thread to prevent blocking the GUI
+            worker.run()                            # Run the analysis in the worker process
+            root.after(0, finish)                   # Tk is only used from the main thread
+
+        def finish():                               # After the process completes, update the GUI (re-enable buttons)
+            label_processing.pack_forget()
+            button_start.pack(pady=20)
+            button_close.pack(pady=20)
+        threading.Thread(target=run_analysis, daemon=True).start()   # Start waiting in a new thread
+
+    def close():                                    # Close the window
+        print('Close')
+        worker.close()
+        root.destroy()
+
+    root = tk.Tk()                                              # Create the main window
+    root.title('Analysis Workflow')                             # Set the title of the window
+    root.geometry('400x200')                                    # Set the window size to 400x200 pixels
+    button_start = tk.Button(root, text='Start', command=start) # Create the "Start" button
+    button_start.pack(pady=20)
+    button_close = tk.Button(root, text='Close', command=close) # Create the "Close" button
+    button_close.pack(pady=20)
+    root.protocol("WM_DELETE_WINDOW", close)
+
+    root.mainloop()                                             # Start the main loop of the window
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
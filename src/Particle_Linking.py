@@ -0,0 +1,92 @@
+import numpy as np
+
+# Particles of a movie found by grouping the maxima of every frame (locate_maxima_batch) with a KD-tree, instead of the
+# dense 2-D gradient histogram and locate_maxima on it. Only the pixels within radius of a maxima are kept, so the memory
+# grows with the number of maxima and not with the image area.
+#
+#   linker = Particle_Linker().fit(maxima, shape)
+#   linker.positions_                       # (y, x) of every particle, in the order of locate_maxima (row by row)
+#   linker.particles_                       # y, x, centroid, score, count, first and last frame of every particle
+#   compare_with_histogram(maxima, shape)   # Particles found by both engines, for a regression check
+#
+# The score of a pixel is the value the gradient histogram has there: every maxima within radius pixels (Chebyshev
+# distance) adds 3, 2 or 1 by distance. A pixel is a particle when its score is above threshold and no pixel within
+# separation pixels has a higher score, the threshold and the box of locate_maxima(histogram_2d, 4, 5), so the particles
+# are the ones of the histogram. With the default threshold a particle needs at least 2 maxima. The maxima within
+# separation pixels of a particle are grouped with it (DBSCAN-like, the nearest particle wins) for its count, centroid
+# and first and last frame.
+
+PARTICLE_DTYPE = np.dtype([('y', np.int64), ('x', np.int64), ('y_centroid', np.float64), ('x_centroid', np.float64), ('score', np.float64),
+                           ('count', np.int64), ('first_frame', np.int64), ('last_frame', np.int64)])
+
+class Particle_Linker:
+        def __init__(self, radius=2, separation=5, threshold=4):
+            self.radius = radius                # Maxima closer than radius + 1 pixels add to the score of a pixel, 3 - distance each
+            self.separation = separation        # Two particles are at least separation + 1 pixels apart, the box of locate_maxima
+            self.threshold = threshold          # Score of a particle, above it
+
+        def pixels(self, y, x, width):  # Unique pixels of (y, x), row by row as np.argwhere, and the index of every input in them
+            pixels, inverse = np.unique(y * width + x, return_inverse=True)
+            return np.column_stack((pixels // width, pixels % width)), inverse.ravel()
+
+        def fit(self, maxima, shape=None):      # shape of the movie or of a frame, without it the image is as large as the maxima need
+            from scipy.spatial import cKDTree
+            self.particles_ = np.empty(0, dtype=PARTICLE_DTYPE)
+            self.positions_ = np.empty((0, 2), dtype=np.int64)
+            if len(maxima) == 0:
+                return self
+            y, x, frame = (np.asarray(maxima[name], dtype=np.int64) for name in ('y', 'x', 'frame'))
+            height, width = shape[-2:] if shape is not None else (int(y.max()) + self.radius + 1, int(x.max()) + self.radius + 1)
+            # Pixels with at least one maxima: number of maxima, first and last frame
+            occupied, inverse = self.pixels(y, x, width)
+            counts = np.bincount(inverse, minlength=len(occupied))
+            first = np.full(len(occupied), np.iinfo(np.int64).max)
+            last = np.zeros(len(occupied), dtype=np.int64)
+            np.minimum.at(first, inverse, frame)
+            np.maximum.at(last, inverse, frame)
+            # Score of every pixel within radius of a maxima, the kernel of counts_gradient spread from every occupied pixel
+            offsets = np.arange(-self.radius, self.radius + 1)
+            dy, dx = (offset.ravel() for offset in np.meshgrid(offsets, offsets, indexing='ij'))
+            kernel = self.radius + 1 - np.maximum(np.abs(dy), np.abs(dx))
+            spread_y, spread_x = occupied[:, :1] + dy, occupied[:, 1:] + dx
+            inside = (spread_y >= 0) & (spread_y < height) & (spread_x >= 0) & (spread_x < width)   # The histogram drops the parts outside the image
+            pixels, inverse = self.pixels(spread_y[inside], spread_x[inside], width)
+            score = np.bincount(inverse, (kernel * counts[:, None])[inside], len(pixels))
+            # Particles: pixels above the threshold with no higher score within separation, equal scores are all kept as in locate_maxima
+            candidates = np.flatnonzero(score > self.threshold)
+            pairs = cKDTree(pixels[candidates]).query_pairs(self.separation, p=np.inf, output_type='ndarray')
+            peak = np.ones(len(candidates), dtype=bool)
+            peak[pairs[:, 0][score[candidates[pairs[:, 0]]] < score[candidates[pairs[:, 1]]]]] = False
+            peak[pairs[:, 1][score[candidates[pairs[:, 1]]] < score[candidates[pairs[:, 0]]]]] = False
+            peaks = candidates[peak]            # Already row by row, the pixels are sorted
+            self.positions_ = pixels[peaks]
+            particles = np.zeros(len(peaks), dtype=PARTICLE_DTYPE)
+            particles['y'], particles['x'], particles['score'] = pixels[peaks, 0], pixels[peaks, 1], score[peaks]
+            if len(peaks):
+                # Every occupied pixel joins the nearest particle within separation, the others are left out
+                distance, nearest = cKDTree(self.positions_).query(occupied, p=np.inf, distance_upper_bound=self.separation)
+                member = np.isfinite(distance)
+                nearest, weights = nearest[member], counts[member]
+                particles['count'] = np.bincount(nearest, weights, len(peaks))
+                with np.errstate(invalid='ignore'):                             # A particle without maxima of its own has no centroid
+                    particles['y_centroid'] = np.bincount(nearest, weights * occupied[member, 0], len(peaks)) / particles['count']
+                    particles['x_centroid'] = np.bincount(nearest, weights * occupied[member, 1], len(peaks)) / particles['count']
+                particles['first_frame'] = np.iinfo(np.int64).max
+                np.minimum.at(particles['first_frame'], nearest, first[member])
+                np.maximum.at(particles['last_frame'], nearest, last[member])
+            self.particles_ = particles
+            return self
+
+def compare_with_histogram(maxima, shape, linker=None):  # Particles of the KD-tree and of the histogram (histogram_2d_gradient, locate_maxima(histogram, 4, 5)) on the same maxima
+    from BBM_Functions import BBM_Class
+    BBM = BBM_Class()
+    linker = linker or Particle_Linker()
+    histogram_positions = np.asarray(BBM.locate_maxima(BBM.histogram_2d_gradient(shape, maxima), linker.threshold, linker.separation)[1]).reshape(-1, 2)
+    tree_positions = linker.fit(maxima, shape).positions_
+    report = {'histogram': len(histogram_positions), 'kdtree': len(tree_positions), 'same_pixel': 0, 'within_1_pixel': 0}
+    if len(histogram_positions) and len(tree_positions):
+        from scipy.spatial import cKDTree
+        distance = cKDTree(tree_positions).query(histogram_positions, p=np.inf)[0]   # Closest particle of the KD-tree to every particle of the histogram
+        report['same_pixel'], report['within_1_pixel'] = int(np.sum(distance == 0)), int(np.sum(distance <= 1))
+    report['identical'] = len(histogram_positions) == len(tree_positions) and np.array_equal(histogram_positions, tree_positions)
+    return report                       # Number of particles of every engine and of histogram particles found by the KD-tree
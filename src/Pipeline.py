@@ -0,0 +1,345 @@
+import os
+import numpy as np
+import warnings
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from BBM_Functions import BBM_Class
+from Fast_HMM import Gaussian_HMM
+from Step_Detection import Step_Detector
+from Particle_Linking import Particle_Linker
+from Trace_Plots import Plot_Renderer
+from Stage_Profiler import Stage_Profiler, NULL_PROFILER
+from Traces import Trace_Matrix
+from Shared_Movie import Shared_Array, attach
+BBM = BBM_Class()                       # Create an instance of the class
+
+# Analysis stages shared by the GUI (GUIs.py) and the headless batch runner (Batch.py). Nothing in here opens a window.
+# Every stage takes an optional Stage_Profiler, the default NULL_PROFILER measures nothing, and the expensive stages an
+# optional Stage_Cache with the key of their result (see stage_key), so an unchanged stage is read back instead of computed.
+
+def stage_key(cache, stage, *parents, **parameters):    # Cache key of a stage from the keys of the stages it depends on, None without cache
+    return None if cache is None else cache.key(stage, *parents, **parameters)
+
+# Prepare data for the h analysis
+def data_optimization(data, shape, n_frames=4000, temporal_step=None, profiler=NULL_PROFILER, cache=None, cache_key=None): # Function to optimize the data for the h analysis, temporal_step=N estimates the background every N frames
+    arrays = cache.load(cache_key) if cache is not None else None
+    if arrays is not None:                  # The stack is not cached when it takes more than half the cache, data is then None
+        print("Background removal and normalization read from the cache")
+        data = arrays.get('data')
+        return data, (data.shape if data is not None else tuple(arrays['shape'])), np.array(arrays['max_frame'])
+    if shape[0] >= n_frames:
+        data = data[0:n_frames-1]           # Crop the data to the specified number of frames
+        shape = data.shape
+    elif shape[0] <= n_frames:              # Process the original data if it has fewer frames than n_frames
+        pass
+    # Background removal, normalization and maximum projection, streamed over chunks of frames
+    with profiler.stage('data_optimization', frames=shape[0]):
+        data, max_frame = BBM.preprocess(data, temporal_step=temporal_step)
+    if cache is not None:
+        stack = {'data': data} if data.nbytes <= cache.max_bytes // 2 else {}
+        cache.save(cache_key, max_frame=max_frame, shape=np.array(shape), **stack)
+    return data, shape, max_frame
+
+# Create results folder where all the results will be saved, use the folder path parameter and use the file name to create a folser
+def create_results_folders(file_path, folder_path):
+    results_path = f"{folder_path}/{os.path.splitext(os.path.basename(file_path))[0]}_Results"
+    positive_path = f"{results_path}/Positive"
+    false_positive_path = f"{results_path}/False_Positive"
+    for path in (results_path, positive_path, false_positive_path):
+        if not os.path.exists(path):    # Check if the folder already exists
+            os.makedirs(path)           # Create the folder if it doesn't exist
+    return results_path, positive_path, false_positive_path
+
+# Locate the particles and save the histogram, the maximum projection and the positions, in the results store and/or the legacy txt files.
+# With a cache, data is only needed when the positions are not cached; when data is None it is computed again by recompute_data().
+# subpixel=N also fits the sub-pixel position of every maxima and saves their histogram on a grid N times finer (the cache key must then include subpixel)
+# linking='kdtree' groups the maxima with Particle_Linking.Particle_Linker instead of the histogram, the same particles without the dense image
+def get_positions(data, shape, h, max_frame, results_path, store=None, legacy_txt=True, summary_plots=True, profiler=NULL_PROFILER, cache=None, cache_key=None, recompute_data=None,
+                  subpixel=None, linking='histogram'):
+    arrays = cache.load(cache_key) if cache is not None else None
+    if arrays is not None:
+        print("Particle positions read from the cache")
+        maxima_locations_arr_joined = np.array(arrays['positions'])
+        histogram_2d = np.array(arrays['histogram_2d']) if 'histogram_2d' in arrays else None
+        maxima, particles = np.array(arrays['maxima']), (np.array(arrays['particles']) if 'particles' in arrays else None)
+        maxima_locations_arr, maxima_locations_quantity = [0], len(maxima_locations_arr_joined)
+        localizations = np.array(arrays['localizations']) if 'localizations' in arrays else None
+    else:
+        if data is None:
+            data = recompute_data()
+        maxima, histogram_2d, particles, (maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity) = locate_positions(data, shape, h, profiler, linking)
+        localizations = None
+        if subpixel:
+            with profiler.stage('localize_subpixel', maxima=len(maxima)):
+                localizations = BBM.localize_subpixel(data, maxima)
+        if cache is not None:
+            optional = {'histogram_2d': histogram_2d, 'particles': particles, 'localizations': localizations}
+            cache.save(cache_key, maxima=maxima, positions=maxima_locations_arr_joined.reshape(-1, 2), **{name: array for name, array in optional.items() if array is not None})
+
+    with profiler.stage('save_positions'):
+        if histogram_2d is None and (summary_plots or legacy_txt):     # The figure and the text file still show the 2-D histogram
+            histogram_2d = BBM.histogram_2d_gradient(shape, maxima)
+        save_positions(histogram_2d, max_frame, maxima_locations_arr_joined, results_path, store, legacy_txt, summary_plots, particles)
+        if subpixel and localizations is not None:
+            save_localizations(localizations, max_frame.shape, subpixel, results_path, store, legacy_txt, summary_plots)
+
+    # Return the maxima locations
+    return maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity
+
+def locate_positions(data, shape, h, profiler=NULL_PROFILER, linking='histogram'):  # Maxima of every frame, their 2-D histogram (None with the KD-tree), the particle table (None with the histogram) and the particles
+    # Locate maxima in the data, frame by frame
+    with profiler.stage('locate_maxima', frames=len(data)):
+        maxima = BBM.locate_maxima_batch(data, h, 5)
+    profiler.count('locate_maxima', maxima=len(maxima))
+
+    if linking == 'kdtree':             # Particles grouped from the maxima, memory proportional to the number of maxima
+        with profiler.stage('link_maxima', maxima=len(maxima)):
+            linker = Particle_Linker().fit(maxima, shape)
+        print(f"Maxima linked into {len(linker.positions_)} particles")
+        profiler.count('link_maxima', particles=len(linker.positions_))
+        return maxima, None, linker.particles_, ([0], linker.positions_, len(linker.positions_))
+    elif linking != 'histogram':
+        raise ValueError(f"Unknown particle linking '{linking}', expected 'histogram' or 'kdtree'")
+
+    # Show 2-dimensional histogram and data with maxima locations
+    with profiler.stage('histogram_2d_gradient', maxima=len(maxima)):
+        histogram_2d = BBM.histogram_2d_gradient(shape, maxima)
+        maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity = BBM.locate_maxima(histogram_2d, 4, 5)
+        maxima_locations_arr_joined = np.array(maxima_locations_arr_joined)                         # Save the maxima locations in txt file
+    profiler.count('histogram_2d_gradient', particles=maxima_locations_quantity)
+    return maxima, histogram_2d, None, (maxima_locations_arr, maxima_locations_arr_joined, maxima_locations_quantity)
+
+# Trace_Matrix with the counts of every particle in the movie dtype, read from the cache when the positions and frame interval did not change
+def extract_traces(data_full, maxima_locations_arr_joined, maxima_locations_quantity, frame_interval, profiler=NULL_PROFILER, cache=None, cache_key=None):
+    arrays = cache.load(cache_key) if cache is not None else None
+    if arrays is not None:
+        print("Traces read from the cache")
+        return Trace_Matrix(np.array(arrays['time']), np.array(arrays['counts']))
+    with profiler.stage('extract_intensities_max', frames=len(data_full), traces=maxima_locations_quantity):
+        counts = BBM.extract_counts(data_full, maxima_locations_arr_joined, maxima_locations_quantity, box=3)
+    traces = Trace_Matrix(BBM.time_axis(len(data_full), frame_interval), counts)
+    if cache is not None:
+        cache.save(cache_key, time=traces.time, counts=traces.counts)
+    return traces
+
+def save_positions(histogram_2d, max_frame, maxima_locations_arr_joined, results_path, store=None, legacy_txt=True, summary_plots=True, particles=None):
+    # Create and save the figures
+    if summary_plots:
+        import matplotlib.pyplot as plt                                                             # Only imported when figures are drawn
+        fig1, ax1 = BBM.plot_images(histogram_2d, maxima=maxima_locations_arr_joined, title='Two-Dimmentional Histogram', normalize=False, cmap='gray', lable="Particle occurrence (factor of 3)")  # Plot the first image (2D histogram)
+        fig1.savefig(f"{results_path}/2d_histogram.png")                                            # Save the figure to the specified path
+        fig2, ax2 = BBM.plot_images(max_frame, cmap='gray', title="Maximum Projection", lable="Normalized Counts Recived per Pixel")  # Plot the second image (max frame)
+        ax2.set_title('Maximum Projection')
+        fig2.savefig(f"{results_path}/Maximum Projection.png")                                      # Save the figure to the specified path
+        plt.close(fig1)                                                                             # Close the figures
+        plt.close(fig2)
+    if store is not None:
+        store.set_positions(maxima_locations_arr_joined, histogram_2d, max_frame)
+        if particles is not None:
+            store.set_particles(particles)
+    if legacy_txt:
+        np.savetxt(f"{results_path}/2d_histogram.txt", histogram_2d)                                # Save the histogram in txt file
+        np.savetxt(f"{results_path}/Maximum Projection.txt", max_frame)                             # Save the max frame in txt file
+
+    # Save the maxima locations in txt file
+    if legacy_txt:
+        trace_numbers = np.arange(maxima_locations_arr_joined.shape[0]).reshape(-1, 1)  # Create an array with trace numbers
+        new_array = np.hstack((trace_numbers, maxima_locations_arr_joined))             # Combine the trace numbers with the maxima locations
+        header = 'Trace Number, y, x'                                                   # Create a header for the txt file
+        np.savetxt(f"{results_path}/Particles_Positions.txt", new_array, header=header, comments='', delimiter=',')
+
+# Sub-pixel positions of all the maxima and their histogram on a grid upsampling times finer than the camera pixels
+def save_localizations(localizations, shape, upsampling, results_path, store=None, legacy_txt=True, summary_plots=True):
+    histogram_subpixel = BBM.histogram_subpixel(shape, localizations, upsampling)
+    print(f"Sub-pixel histogram of {len(localizations)} localizations created, {histogram_subpixel.shape[0]} x {histogram_subpixel.shape[1]} pixels")
+    if summary_plots:
+        import matplotlib.pyplot as plt
+        fig, ax = BBM.plot_images(histogram_subpixel, title=f'Sub-pixel Histogram (x{upsampling})', normalize=False, cmap='gray', lable="Localizations per sub-pixel")
+        fig.savefig(f"{results_path}/Subpixel_Histogram.png")
+        plt.close(fig)
+    if store is not None:
+        store.set_localizations(localizations, histogram_subpixel)
+    if legacy_txt:
+        header = 'Frame, y, x, Intensity, Sigma'
+        np.savetxt(f"{results_path}/Localizations.txt", np.column_stack([localizations[name] for name in localizations.dtype.names]), header=header, comments='', delimiter=',',
+                   fmt=['%d', '%.3f', '%.3f', '%.6g', '%.3f'])
+
+SILHOUETTE_THRESHOLD = 0.65            # Traces with a 2-state silhouette coefficient above the threshold are positive
+STEP_SNR_THRESHOLD = 3.0               # Traces whose last bleach step is higher than 3 times the noise are positive (steps backend)
+# hmmlearn.GMMHMM per trace, Fast_HMM.Gaussian_HMM on the whole chunk of traces, or the change-point detection of Step_Detection.py (no HMM, any number of steps)
+HMM_BACKENDS = ('hmmlearn', 'fast', 'steps')
+CHUNK_SIZES = {'hmmlearn': 4, 'fast': 64, 'steps': 256}             # Traces sent to a worker at once, the vectorized backends are more efficient on larger chunks
+# Model selection between 1 and 2 states: name of the statistic and threshold above which the 2-state model is kept
+MODEL_SELECTIONS = {'silhouette': ('Silhouette coefficient', SILHOUETTE_THRESHOLD),
+                    'bic': ('BIC difference', 0.0),                 # BIC(1 state) - BIC(2 states)
+                    'likelihood_ratio': ('Likelihood ratio', 11.07), # 2 * (logL(2 states) - logL(1 state)), chi-squared with 5 degrees of freedom at p = 0.05
+                    'steps': ('Step SNR', STEP_SNR_THRESHOLD)}      # Last bleach step over the noise, only with the steps backend
+LINKING_MODES = ('histogram', 'kdtree')  # Particles from the 2-D histogram of the maxima or from the KD-tree of Particle_Linking.py
+HMM_PARAMETERS = {1: 2, 2: 7}           # Free parameters of a 1-D Gaussian HMM (start, transitions, means, variances) by number of states
+
+# Choose between the fitted 2-state model and a single state. log_likelihood_2 is only called by the likelihood based selections
+def select_model(emissions, i, states_2, log_likelihood_2, selection='silhouette', silhouette_method='exact', random_state=None, profiler=NULL_PROFILER):
+    _, threshold = MODEL_SELECTIONS[selection]
+    trace = emissions[i + 1]
+    with profiler.stage('calculate_silhouette' if selection == 'silhouette' else 'model_selection', traces=1):
+        if selection == 'silhouette':
+            score = BBM.calculate_silhouette(emissions, states_2, int(i), silhouette_method, random_state=random_state)
+        else:
+            log_likelihood_1 = -0.5 * trace.size * (np.log(2 * np.pi * max(np.var(trace), 1e-12)) + 1)   # A 1-state HMM is a single Gaussian
+            if selection == 'bic':
+                score = (HMM_PARAMETERS[1] - HMM_PARAMETERS[2]) * np.log(trace.size) + 2 * (log_likelihood_2() - log_likelihood_1)
+            else:
+                score = 2 * (log_likelihood_2() - log_likelihood_1)
+    if score > threshold:
+        return 2, states_2, score
+    return 1, np.zeros(trace.size, dtype=int), score        # A 1-state HMM assigns every frame to state 0
+
+# Choose the number of states of a single trace. The trace number is used as the HMM seed so the serial and parallel runs give the same result
+def classify_trace(emissions, i, random_state=None, selection='silhouette', silhouette_method='exact', profiler=NULL_PROFILER):
+    from sklearn.exceptions import ConvergenceWarning                               # Imported with the first trace, as hmmlearn in BBM_Class.fit_hmm
+    warnings.filterwarnings("ignore", category=ConvergenceWarning)                  # Suppress specific warnings if needed
+    trace = emissions[i + 1].reshape(-1, 1)
+    with profiler.stage('states_assignment', traces=1):
+        gm = BBM.fit_hmm(2, emissions, int(i), random_state)                        # The 2-state model is fitted once and reused when it is selected
+        states_2 = gm.predict(trace)
+    return select_model(emissions, i, states_2, lambda: gm.score(trace), selection, silhouette_method, random_state, profiler)
+
+def classify_chunk_fast(chunk, indices, selection='silhouette', silhouette_method='exact', profiler=NULL_PROFILER):  # Same decision as classify_trace, with one vectorized 2-state fit for all the traces of the chunk
+    with profiler.stage('states_assignment', traces=len(indices)):
+        model = Gaussian_HMM(2).fit(chunk[1:])
+        states_2 = model.predict(chunk[1:])
+    return [(i, *select_model(chunk, j, states_2[j], lambda j=j: model.log_likelihood_[j], selection, silhouette_method, i, profiler)) for j, i in enumerate(indices)]
+
+# Steps found by change-point detection instead of an HMM fit. A positive trace gets one state per segment (0 is the lowest level), the number of
+# segments as its number of states and the height of its last bleach step over the noise as its score
+def classify_chunk_steps(chunk, indices, profiler=NULL_PROFILER):
+    with profiler.stage('states_assignment', traces=len(indices)):
+        detector = Step_Detector().fit(chunk[1:])
+        states = detector.predict()
+    results = []
+    for j, i in enumerate(indices):
+        score = float(detector.step_snr_[j])
+        if score > STEP_SNR_THRESHOLD:
+            results.append((i, len(detector.levels_[j]), states[j], score))
+        else:
+            results.append((i, 1, np.zeros(states.shape[1], dtype=int), score))
+    return results
+
+# Worker function: chunk holds the time row followed by the traces listed in indices. Returns the classifications and the stages measured in the worker
+def classify_chunk(chunk, indices, backend='hmmlearn', selection='silhouette', silhouette_method='exact', profile=False):
+    profiler = Stage_Profiler() if profile else NULL_PROFILER
+    if backend == 'steps':
+        return classify_chunk_steps(chunk, indices, profiler), profiler.stages
+    if backend == 'fast':
+        return classify_chunk_fast(chunk, indices, selection, silhouette_method, profiler), profiler.stages
+    return [(i, *classify_trace(chunk, j, i, selection, silhouette_method, profiler)) for j, i in enumerate(indices)], profiler.stages
+
+def classify_shared_chunk(handles, indices, backend='hmmlearn', selection='silhouette', silhouette_method='exact', profile=False):  # classify_chunk in a worker, on the time and counts shared by Shared_Movie.Shared_Array
+    time, counts = (attach(handle) for handle in handles)                               # Read-only views, only the handles and the indices were pickled
+    return classify_chunk(Trace_Matrix(time, counts).emissions(indices), indices, backend, selection, silhouette_method, profile)
+
+# Classify all traces, yields (i, number_of_states, states, silhouette_avg) as soon as each trace (workers=1) or chunk of traces is finished.
+# With a Stage_Cache.Classification_Checkpoint the traces already classified are yielded first and only the others are classified
+# mp_context is the multiprocessing context of the process pool (the default one of the platform by default), the GUI spawns its workers
+def classify_traces(traces, maxima_locations_quantity, workers=1, chunk_size=None, backend='hmmlearn', selection='silhouette', silhouette_method='exact', profiler=NULL_PROFILER,
+                    checkpoint=None, mp_context=None):
+    if backend not in HMM_BACKENDS:
+        raise ValueError(f"Unknown HMM backend: {backend}")
+    if selection not in MODEL_SELECTIONS:
+        raise ValueError(f"Unknown model selection: {selection}")
+    if (backend == 'steps') != (selection == 'steps'):
+        raise ValueError("The steps backend is only used with the steps model selection")
+    indices = list(range(maxima_locations_quantity))
+    if checkpoint is None:
+        yield from classify_indices(traces, indices, workers, chunk_size, backend, selection, silhouette_method, profiler, mp_context)
+        return
+    threshold = MODEL_SELECTIONS[selection][1]
+    pending = []
+    for i in indices:                                                                # The decision is made again with the current threshold
+        number_of_states, score = checkpoint.number_of_states[i], checkpoint.score[i]
+        if not checkpoint.done[i] or (score > threshold and number_of_states < 2):  # The 2-state path of a rejected trace was not kept, it is fitted again
+            pending.append(i)
+        elif score > threshold:
+            yield i, int(number_of_states), checkpoint.states[i].astype(int), score
+        else:
+            yield i, 1, np.zeros(traces.n_frames, dtype=int), score
+    if len(pending) < len(indices):
+        print(f"{len(indices) - len(pending)} traces read from the checkpoint, {len(pending)} left to classify")
+    try:
+        for result in classify_indices(traces, pending, workers, chunk_size, backend, selection, silhouette_method, profiler, mp_context):
+            checkpoint.add(*result)
+            yield result
+    finally:
+        checkpoint.flush()                                                          # Also when the analysis is stopped, so the next run resumes from here
+
+# Classify the listed traces of a Trace_Matrix. Every chunk is converted to a float64 matrix with the time in row 0, as the BBM_Class methods expect
+def classify_indices(traces, pending, workers=1, chunk_size=None, backend='hmmlearn', selection='silhouette', silhouette_method='exact', profiler=NULL_PROFILER, mp_context=None):
+    chunk_size = chunk_size or CHUNK_SIZES[backend]
+    if workers == 1:
+        step = 1 if backend == 'hmmlearn' else chunk_size                           # hmmlearn traces are streamed one by one
+        for start in range(0, len(pending), step):
+            indices = pending[start:start + step]
+            results, stages = classify_chunk(traces.emissions(indices), indices, backend, selection, silhouette_method, profiler.enabled)
+            profiler.merge(stages)
+            yield from results
+        return
+    # At most two chunks per worker are submitted ahead, so all the workers stay busy but a consumer that pauses (or stops
+    # reading) also stops the classification, and a stopped classification does not wait for the chunks not started yet.
+    # The counts are shared with the workers once, before the pool starts, instead of pickling the traces of every chunk
+    chunks = (pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size))
+    shared = [Shared_Array.from_array(traces.time), Shared_Array.from_array(traces.counts)]
+    handles = tuple(array.handle for array in shared)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+    running = set()
+    try:
+        while True:
+            for indices in itertools.islice(chunks, 2 * workers - len(running)):
+                running.add(executor.submit(classify_shared_chunk, handles, indices, backend, selection, silhouette_method, profiler.enabled))
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results, stages = future.result()
+                profiler.merge(stages)          # Stages measured in the worker processes: CPU time and peak memory of the workers
+                yield from results
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for array in shared:
+            array.close()
+
+default_plots = None                    # Plot_Renderer used when process_traces is not given one, draws every figure with one reused template
+
+# Plot a single classified trace of a Trace_Matrix and save it into the Positive or False_Positive folder and/or the results store. Without classification the trace is classified here.
+# plots is a Trace_Plots.Plot_Renderer that draws, queues or skips the C_/PR_/PE_ figures
+def process_traces(traces, i, positive_path, false_positive_path, classification=None, selection='silhouette', store=None, legacy_txt=True, plots=None, profiler=NULL_PROFILER):
+    global default_plots
+
+    if classification is None:
+        classification = classify_trace(traces.emissions([i]), 0, random_state=i, selection=selection, profiler=profiler)
+    number_of_states, states, score = classification
+
+    label, threshold = MODEL_SELECTIONS[selection]
+    print(f"Trace {i}: {number_of_states} states(s). {label} {round(score, 2)}/{threshold}.")
+
+    if number_of_states >= 2:
+        mono, trace_path, trace_name = False, positive_path, f"Trace_{i}"
+    else:
+        mono, trace_path, trace_name = True, false_positive_path, f"Mono_Trace_{i}"
+
+    # Plot the counts, the received and the emitted photons (converted from the counts of this trace only)
+    time, counts, photons_received, photons_emitted = traces.trace(i)
+    if plots is None:
+        if default_plots is None:
+            default_plots = Plot_Renderer('all')
+        plots = default_plots
+    with profiler.stage('plot_traces', traces=1):
+        plots.render_trace(time, counts, photons_received, photons_emitted, states, mono, trace_path, trace_name)
+
+    # Save trace in the results store and/or in txt file
+    with profiler.stage('save_traces', traces=1):
+        if store is not None:
+            store.add_trace(i, number_of_states, states, score)
+        if legacy_txt:
+            trace = np.column_stack((time, counts, photons_received, photons_emitted))
+            header = "Time_sec, EMCCD_Counts, Photons_Received_by_EMCCD, Emitted_Photons_ by_the_Sample"
+            np.savetxt(f"{trace_path}/{trace_name}.txt", trace, header=header)
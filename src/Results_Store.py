@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+
+# All the results of a movie in one compressed NPZ container (Results.npz in the _Results folder) instead of one text file
+# per trace. The traces are stored in blocks of block_size traces, so reading one trace only decompresses its block.
+#
+#   results = load_results(f"{results_path}/Results.npz")
+#   results.positions, results.histogram_2d, results.max_projection, results.number_of_states, results.score
+#   results.localizations, results.histogram_subpixel      # when the analysis ran with sub-pixel localization
+#   results.particles                                       # when the particles were linked with the KD-tree (count, first and last frame, ...)
+#   trace = results.trace(12)     # dict with time, counts, photons_received, photons_emitted, states, number_of_states, score, position
+
+TRACE_ARRAYS = ('counts', 'photons_received', 'photons_emitted', 'states')     # Blocks of every trace array, counts in the dtype of the movie
+
+class Results_Store:                    # Collects the results while the analysis runs and writes the container once with save()
+        def __init__(self, results_path, file_name="Results.npz", block_size=256, parameters=None):
+            self.path = os.path.join(results_path, file_name)
+            self.block_size = block_size
+            self.parameters = parameters or {}
+            self.arrays = {}
+            self.states = None
+
+        def set_positions(self, positions, histogram_2d, max_projection):  # Particle positions (y, x), 2-D histogram and maximum projection
+            self.arrays['positions'] = np.asarray(positions).reshape(-1, 2)
+            if histogram_2d is not None:                                    # Not computed when the particles are linked with the KD-tree and no figure is drawn
+                self.arrays['histogram_2d'] = histogram_2d
+            self.arrays['max_projection'] = max_projection
+
+        def set_particles(self, particles):                                 # Particle_Linking.PARTICLE_DTYPE table, one row per position
+            self.arrays['particles'] = particles
+
+        def set_localizations(self, localizations, histogram_subpixel):  # Sub-pixel maxima (frame, y, x, intensity, sigma) and their upsampled histogram
+            self.arrays['localizations'] = localizations
+            self.arrays['histogram_subpixel'] = histogram_subpixel
+
+        def set_traces(self, traces):                                       # Traces.Trace_Matrix, the photons are converted block by block when saving
+            n_traces = traces.n_traces
+            self.arrays['time'] = traces.time
+            self.traces = traces
+            self.states = np.zeros((n_traces, traces.n_frames), dtype=np.int8)
+            self.number_of_states = np.zeros(n_traces, dtype=np.int8)      # 0 until the trace is classified
+            self.score = np.full(n_traces, np.nan)
+
+        def add_trace(self, i, number_of_states, states, score):           # Classification of trace i, in any order
+            self.states[i] = states
+            self.number_of_states[i] = number_of_states
+            self.score[i] = score
+
+        def save(self):                                                     # Write the container, through a temporary file so a crash never leaves a broken one
+            arrays = dict(self.arrays, block_size=np.array(self.block_size), parameters=np.array(json.dumps(self.parameters)))
+            if self.states is not None:
+                arrays['number_of_states'], arrays['score'] = self.number_of_states, self.score
+                for block, start in enumerate(range(0, self.states.shape[0], self.block_size)):
+                    rows = slice(start, start + self.block_size)
+                    arrays[f"counts_{block:05d}"] = self.traces.counts[rows]      # Movie dtype, uint16 for the cameras
+                    arrays[f"photons_received_{block:05d}"], arrays[f"photons_emitted_{block:05d}"] = self.traces.photons(rows)
+                    arrays[f"states_{block:05d}"] = self.states[rows]
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(temporary_path, self.path)
+            print(f"Results saved to {self.path}")
+
+class Results:                          # Read access to a Results.npz container, arrays are decompressed on first use
+        def __init__(self, path):
+            self.file = np.load(path)
+            self.block_size = int(self.file['block_size'])
+            self.parameters = json.loads(str(self.file['parameters']))
+            self.blocks = {}            # Last decompressed block of every trace array
+
+        def __getattr__(self, name):    # positions, histogram_2d, max_projection, time, number_of_states, score, localizations, histogram_subpixel, particles
+            if name in ('file', 'blocks'):
+                raise AttributeError(name)
+            if name not in self.file.files:
+                raise AttributeError(f"No '{name}' in the results")
+            value = self.file[name]
+            setattr(self, name, value)  # Decompressed once, later reads do not reach __getattr__
+            return value
+
+        @property
+        def n_traces(self):
+            return len(self.file['number_of_states']) if 'number_of_states' in self.file.files else 0
+
+        def block(self, name, block):
+            if self.blocks.get(name, (None,))[0] != block:
+                self.blocks[name] = (block, self.file[f"{name}_{block:05d}"])
+            return self.blocks[name][1]
+
+        def trace(self, i):             # All the results of trace i
+            if not 0 <= i < self.n_traces:
+                raise IndexError(f"Trace {i} is out of range for {self.n_traces} traces")
+            block, row = divmod(i, self.block_size)
+            trace = {name: self.block(name, block)[row] for name in TRACE_ARRAYS}
+            trace.update(time=self.time, number_of_states=int(self.number_of_states[i]), score=float(self.score[i]), position=self.positions[i])
+            return trace
+
+        def close(self):
+            self.file.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+def load_results(path):                 # path of Results.npz or of the _Results folder
+    if os.path.isdir(path):
+        path = os.path.join(path, "Results.npz")
+    return Results(path)
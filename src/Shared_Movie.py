@@ -0,0 +1,135 @@
+import os
+import glob
+import shutil
+import weakref
+import tempfile
+import itertools
+import numpy as np
+from multiprocessing import shared_memory
+
+# Arrays shared with the worker processes of a pool without pickling them: the movie stack, the counts of the traces or
+# any array too large to send with every task. The process that creates a Shared_Array owns it and sends its handle
+# (a small tuple) to the workers, which attach() it as a read-only NumPy view of the same memory, nothing is copied.
+#
+#   with Shared_Array.from_array(data_full) as movie:                   # Also reads a lazy ND2/TIF frame source, chunk by chunk
+#       executor.submit(work, movie.handle, start, stop)                # In the worker: data = attach(handle)[start:stop]
+#
+# The memory is a multiprocessing.shared_memory segment (/dev/shm on Linux), or a memory-mapped scratch file in folder
+# when one is given or when /dev/shm is too small for the array. It is released by close() (or the with block), when
+# the Shared_Array is garbage collected or at exit, also after an exception. If the owner is killed, the resource
+# tracker of multiprocessing unlinks the segment and the next Shared_Array removes the scratch files of dead processes.
+# Create the arrays before the pool, so the workers share the resource tracker of the owner.
+
+SCRATCH_PREFIX = "BBM_Shared_"          # Scratch files are named BBM_Shared_<pid>_<n>.dat
+SCRATCH_COUNTER = itertools.count()
+ATTACHED = {}                           # Segments attached by this process, by name, kept open for the next tasks
+
+def release(memory, path):              # Free the segment or the scratch file of a Shared_Array, run once by its finalizer
+    if memory is not None:
+        try:
+            memory.unlink()             # The name is removed now, the memory when the last process closes it
+        except FileNotFoundError:
+            pass
+        try:
+            memory.close()
+        except BufferError:             # Views of the owner still exist, the memory is freed with them
+            pass
+    elif path is not None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def process_exists(pid):                # Whether a process with this pid is running, without sending it anything
+    if os.name == 'nt':                 # os.kill on Windows terminates the process whatever the signal
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.OpenProcess.restype = ctypes.c_void_p
+        handle = kernel32.OpenProcess(0x1000, False, pid)   # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5             # ERROR_ACCESS_DENIED: the process exists but belongs to another user
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(ctypes.c_void_p(handle), ctypes.byref(exit_code))
+            return exit_code.value == 259                   # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(ctypes.c_void_p(handle))
+    try:
+        os.kill(pid, 0)                 # Signal 0 only checks the pid on POSIX
+    except ProcessLookupError:
+        return False
+    except OSError:                     # A process of another user
+        return True
+    return True
+
+def remove_stale_scratch(folder):       # Scratch files left by processes that do not exist anymore
+    for path in glob.glob(os.path.join(folder, f"{SCRATCH_PREFIX}*.dat")):
+        try:
+            pid = int(os.path.basename(path)[len(SCRATCH_PREFIX):].split('_')[0])
+        except ValueError:              # Not a scratch file name
+            continue
+        if not process_exists(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class Shared_Array:
+        def __init__(self, shape, dtype, folder=None):
+            self.shape, self.dtype = tuple(int(n) for n in shape), np.dtype(dtype)
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            if nbytes == 0:
+                folder = None                   # An empty file can not be memory mapped
+            elif folder is None and os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free < nbytes:
+                folder = tempfile.gettempdir()  # Writing past the size of /dev/shm would kill the process with SIGBUS
+            self.memory, self.path = None, None
+            if folder is None:
+                self.memory = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+                self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+                self.handle = ('shared_memory', self.memory.name, self.shape, self.dtype.str)
+            else:
+                remove_stale_scratch(folder)
+                self.path = os.path.join(folder, f"{SCRATCH_PREFIX}{os.getpid()}_{next(SCRATCH_COUNTER)}.dat")
+                self.array = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=self.shape)
+                self.handle = ('file', self.path, self.shape, self.dtype.str)
+            self.finalizer = weakref.finalize(self, release, self.memory, self.path)    # Also runs at exit
+
+        @classmethod
+        def from_array(cls, data, folder=None, chunk_size=256):    # Copy of an array or a frame source, chunk by chunk along the first axis
+            shared = cls(data.shape, data.dtype, folder)
+            for start in range(0, data.shape[0], chunk_size):
+                shared.array[start:start + chunk_size] = data[start:start + chunk_size]
+            return shared
+
+        @property
+        def nbytes(self):
+            return self.array.nbytes
+
+        def close(self):                # The views of the owner must not be used after close, those of the workers stay valid until they detach
+            self.array = None
+            self.finalizer()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+def attach(handle, writable=False):     # NumPy view of a Shared_Array from its handle, read-only unless writable, in any process
+    kind, name, shape, dtype = handle
+    if kind == 'file':
+        return np.memmap(name, dtype=dtype, mode='r+' if writable else 'r', shape=shape)
+    if name not in ATTACHED:
+        ATTACHED[name] = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=ATTACHED[name].buf)
+    array.flags.writeable = writable
+    return array
+
+def detach(handle=None):                # Close the segments attached by this process (all of them by default), the owner still has to close its Shared_Array
+    for name in [handle[1]] if handle is not None else list(ATTACHED):
+        memory = ATTACHED.pop(name, None)
+        if memory is not None:
+            try:
+                memory.close()
+            except BufferError:         # Views still exist in this process, the memory is closed with them
+                pass
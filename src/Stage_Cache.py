@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+# On-disk cache of the analysis stages, so a rerun with another h, frame interval or conversion parameter only recomputes
+# the stages downstream of the change, and a classification stopped midway continues from the last saved trace.
+#
+#   cache = Stage_Cache()                                           # ~/.bbm_cache, 20 GB
+#   movie = cache.file_key(file_path)
+#   key = cache.key('data_optimization', movie, n_frames=4000, temporal_step=None)
+#   arrays = cache.load(key)                                        # dict of arrays, memory mapped, or None
+#   if arrays is None:
+#       cache.save(key, data=data, max_frame=max_frame)
+#
+# A key is the hash of the stage name, the keys of the stages it depends on and its parameters, so any change upstream
+# gives new keys downstream. Every entry is a folder of .npy files. Loading an entry marks it as recently used, and the
+# least recently used entries are deleted when the cache grows over max_bytes.
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser("~"), ".bbm_cache")
+SAMPLE_BYTES = 2**20                    # Bytes read at the start, middle and end of a movie to identify it
+
+class Stage_Cache:
+        def __init__(self, folder=DEFAULT_FOLDER, max_bytes=20 * 1024**3):
+            self.folder = folder
+            self.max_bytes = max_bytes
+            os.makedirs(folder, exist_ok=True)
+
+        def file_key(self, path):       # Hash of the size and of three samples of the movie, the file is never read in full
+            size = os.path.getsize(path)
+            digest = hashlib.sha1(str(size).encode())
+            with open(path, 'rb') as f:
+                for offset in sorted({0, max(size // 2 - SAMPLE_BYTES // 2, 0), max(size - SAMPLE_BYTES, 0)}):
+                    f.seek(offset)
+                    digest.update(f.read(SAMPLE_BYTES))
+            return digest.hexdigest()
+
+        def key(self, stage, *parents, **parameters):   # parents are the keys of the stages this one is computed from
+            description = json.dumps({'stage': stage, 'parents': parents, 'parameters': parameters}, sort_keys=True, default=str)
+            return hashlib.sha1(description.encode()).hexdigest()
+
+        def path(self, key):
+            return os.path.join(self.folder, key)
+
+        def load(self, key):            # Arrays of the entry, memory mapped read-only, or None when the stage has to be computed
+            path = self.path(key)
+            if not os.path.isfile(os.path.join(path, "complete")):
+                return None
+            os.utime(path)              # Most recently used
+            return {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode='r')
+                    for name in os.listdir(path) if name.endswith('.npy')}
+
+        def save(self, key, **arrays):  # Write the entry in a temporary folder, then move it in place so a crash never leaves half an entry
+            path = self.path(key)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            os.makedirs(temporary_path)
+            for name, array in arrays.items():
+                np.save(os.path.join(temporary_path, f"{name}.npy"), np.asarray(array))
+            open(os.path.join(temporary_path, "complete"), 'w').close()
+            if os.path.exists(path):
+                old_path = f"{temporary_path}.old"
+                os.replace(path, old_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(temporary_path, path)
+            self.evict(keep=key)
+
+        def entries(self):              # (last use, size in bytes, key) of every entry
+            entries = []
+            for key in os.listdir(self.folder):
+                path = self.path(key)
+                if os.path.isdir(path) and not key.endswith('.tmp'):
+                    size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                    entries.append((os.path.getmtime(path), size, key))
+            return sorted(entries)
+
+        def evict(self, keep=None):     # Delete the least recently used entries until the cache fits in max_bytes
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                try:
+                    shutil.rmtree(self.path(key))
+                    total -= size
+                except OSError:         # Still memory mapped on Windows, deleted by a later eviction
+                    pass
+
+        def clear(self):
+            for _, _, key in self.entries():
+                shutil.rmtree(self.path(key), ignore_errors=True)
+
+class Classification_Checkpoint:        # Classified traces of a movie, saved in the cache every flush_interval seconds so the classification can resume
+        def __init__(self, cache, key, n_traces, n_frames, flush_interval=10):
+            self.cache, self.key, self.flush_interval = cache, key, flush_interval
+            arrays = cache.load(key)
+            if arrays is not None and arrays['states'].shape == (n_traces, n_frames):
+                self.done = np.array(arrays['done'])
+                self.number_of_states = np.array(arrays['number_of_states'])
+                self.states = np.array(arrays['states'])
+                self.score = np.array(arrays['score'])
+            else:
+                self.done = np.zeros(n_traces, dtype=bool)
+                self.number_of_states = np.zeros(n_traces, dtype=np.int8)
+                self.states = np.zeros((n_traces, n_frames), dtype=np.int8)
+                self.score = np.zeros(n_traces)
+            self.last_flush = time.monotonic()
+            self.changed = False
+
+        def add(self, i, number_of_states, states, score):
+            self.done[i] = True
+            self.number_of_states[i], self.states[i], self.score[i] = number_of_states, states, score
+            self.changed = True
+            if time.monotonic() - self.last_flush > self.flush_interval:
+                self.flush()
+
+        def flush(self):
+            if self.changed:
+                self.cache.save(self.key, done=self.done, number_of_states=self.number_of_states, states=self.states, score=self.score)
+                self.changed = False
+            self.last_flush = time.monotonic()
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import threading
+from contextlib import contextmanager
+
+# Wall time, CPU time, peak memory and item counts of the analysis stages, written as a JSON report into the _Results folder.
+#
+#   profiler = Stage_Profiler()
+#   with profiler.stage('locate_maxima', frames=len(data)):
+#       maxima = BBM.locate_maxima_batch(data, h, 5)
+#   profiler.count('locate_maxima', maxima=len(maxima))
+#   profiler.save(results_path)                 # Profile.json
+#
+# A disabled profiler (Stage_Profiler(False) or NULL_PROFILER) returns the same empty context for every stage, so the
+# instrumented code costs one method call per stage when nothing is measured.
+#
+# The memory of a stage is sampled every 5 ms by a thread that only runs while a stage is open: peak_rss_mb is the highest
+# resident memory of the process during the stage and peak_increase_mb how far it rose above the memory at the start of
+# the stage (the largest over the calls). The peak_rss_mb of the whole report is the high-water mark of the process.
+
+try:
+    import resource
+except ImportError:                     # Windows
+    resource = None
+
+def current_rss_mb():                   # Resident memory of the process now in MB, None when it can not be read
+    try:
+        with open('/proc/self/statm') as f:                             # Linux
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024**2
+    except ImportError:
+        return None
+
+def peak_rss_mb():                      # Peak resident memory of the process in MB, None when it can not be read
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024   # Bytes on macOS, kB on Linux
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    except (ImportError, AttributeError):
+        return None
+
+class RSS_Sampler:                      # Highest resident memory of every open stage call, sampled in a thread while at least one is open
+        def __init__(self, interval=0.005):
+            self.interval = interval
+            self.open = {}              # Call id -> [memory at the start, highest memory seen]
+            self.lock = threading.Lock()
+            self.thread = None
+            self.ids = itertools.count()
+
+        def begin(self):                # Id of the call, None when the memory can not be read
+            rss = current_rss_mb()
+            if rss is None:
+                return None
+            with self.lock:
+                key = next(self.ids)
+                self.open[key] = [rss, rss]
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+            return key
+
+        def end(self, key):             # (peak, increase over the start) of the call, in MB
+            if key is None:
+                return None, None
+            rss = current_rss_mb()
+            with self.lock:
+                start, peak = self.open.pop(key)
+            peak = max(peak, rss)
+            return peak, peak - start
+
+        def run(self):
+            while True:
+                time.sleep(self.interval)
+                rss = current_rss_mb()
+                with self.lock:
+                    if not self.open:   # The thread stops with the last stage, the next stage starts a new one
+                        self.thread = None
+                        return
+                    for memory in self.open.values():
+                        memory[1] = max(memory[1], rss)
+
+class Stage_Profiler:
+        def __init__(self, enabled=True):
+            self.enabled = enabled
+            self.stages = {}            # Stage name -> calls, wall_s, cpu_s, peak_rss_mb, peak_increase_mb and item counts
+            self.start = time.perf_counter()
+            self.sampler = RSS_Sampler()
+
+        def record(self, name):
+            if name not in self.stages:
+                self.stages[name] = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None, 'peak_increase_mb': None, 'items': {}}
+            return self.stages[name]
+
+        @contextmanager
+        def measure(self, name, counts):
+            wall, cpu = time.perf_counter(), time.process_time()
+            memory = self.sampler.begin()
+            try:
+                yield self
+            finally:
+                stage = self.record(name)
+                stage['calls'] += 1
+                stage['wall_s'] += time.perf_counter() - wall
+                stage['cpu_s'] += time.process_time() - cpu
+                self.add_memory(stage, *self.sampler.end(memory))
+                self.add_counts(stage, counts)
+
+        def add_memory(self, stage, peak, increase):
+            if peak is not None:
+                stage['peak_rss_mb'] = max(stage['peak_rss_mb'] or 0, peak)
+            if increase is not None:
+                stage['peak_increase_mb'] = max(stage['peak_increase_mb'] or 0, increase)
+
+        def stage(self, name, **counts):    # Context manager timing one call of the stage, counts are added to its items (frames=, traces=, ...)
+            if not self.enabled:
+                return NULL_STAGE
+            return self.measure(name, counts)
+
+        def count(self, name, **counts):    # Items known only after the stage, e.g. the number of maxima found
+            if self.enabled:
+                self.add_counts(self.record(name), counts)
+
+        def add_counts(self, stage, counts):
+            for item, n in counts.items():
+                stage['items'][item] = stage['items'].get(item, 0) + int(n)
+
+        def merge(self, stages):            # Add the stages measured by another profiler, e.g. in a worker process
+            if not self.enabled:
+                return
+            for name, other in stages.items():
+                stage = self.record(name)
+                stage['calls'] += other['calls']
+                stage['wall_s'] += other['wall_s']
+                stage['cpu_s'] += other['cpu_s']
+                self.add_memory(stage, other['peak_rss_mb'], other.get('peak_increase_mb'))
+                self.add_counts(stage, other['items'])
+                for note in other.get('notes', ()):
+                    if note not in stage.setdefault('notes', []):
+                        stage['notes'].append(note)
+
+        def report(self):
+            stages = {}
+            for name, stage in self.stages.items():
+                stages[name] = dict(stage, throughput_per_s={item: n / stage['wall_s'] for item, n in stage['items'].items() if stage['wall_s'] > 0})
+            return {'total_wall_s': time.perf_counter() - self.start, 'peak_rss_mb': peak_rss_mb(), 'cpu_count': os.cpu_count(),
+                    'platform': platform.platform(), 'python': platform.python_version(), 'stages': stages}
+
+        def save(self, results_path, file_name="Profile.json", **extra):   # extra values (file name, parameters) are added to the report
+            if not self.enabled:
+                return None
+            path = os.path.join(results_path, file_name)
+            with open(path, 'w') as f:
+                json.dump(dict(self.report(), **extra), f, indent=2)
+            return path
+
+class Null_Stage:                       # Context of a disabled profiler, does nothing
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+NULL_STAGE = Null_Stage()
+NULL_PROFILER = Stage_Profiler(enabled=False)
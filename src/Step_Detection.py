@@ -0,0 +1,88 @@
+import numpy as np
+
+# Photobleaching steps of a whole batch of 1-D traces, held as a (n_traces, n_frames) array, found by change-point
+# detection on the cumulative sums of the traces instead of an HMM fit. Every trace is cut into segments of constant
+# intensity by penalized binary segmentation: at each round the split that reduces the squared error of its segment the
+# most is kept if the reduction is larger than penalty * sigma^2 * log(n_frames), sigma being the noise of that segment.
+# The EMCCD noise grows with the signal, so sigma is estimated in every segment, from the cumulative sum of the absolute
+# frame to frame differences. A round costs O(n_traces * n_frames) and is vectorized across the traces.
+#
+#   detector = Step_Detector(max_steps=4).fit(traces)
+#   states = detector.predict()             # Level of every frame, 0 is the lowest segment of the trace
+#   detector.change_points_[i]              # Frames where the steps of trace i happen (first frame after the step)
+#   detector.levels_[i]                     # Mean intensity of every segment of trace i
+#   detector.bleach_steps_                  # Number of downward steps of every trace
+#   detector.step_snr_                      # Height of the last downward step over the noise, 0 without a downward step
+
+class Step_Detector:
+        def __init__(self, max_steps=4, penalty=3.0, min_dwell=3):
+            self.max_steps = max_steps          # Steps per trace at most, max_steps + 1 segments (and states 0 to max_steps)
+            self.penalty = penalty              # Penalty of a step in units of sigma^2 * log(n_frames), 2 is the BIC of a mean change
+            self.min_dwell = min_dwell          # Frames of the shortest segment, so a single noisy frame is not a step
+
+        def noise(self, differences, start, end):   # Noise of the segments [start, end) from their mean absolute frame to frame difference, sqrt(pi) / 2 * E|x[t+1] - x[t]| for Gaussian noise
+            sums = np.take_along_axis(differences, np.maximum(end - 1, start), 1) - np.take_along_axis(differences, start, 1)
+            return np.maximum(np.sqrt(np.pi) / 2 * sums / np.maximum(end - 1 - start, 1), 1e-12)
+
+        def fit(self, traces):
+            x = np.asarray(traces, dtype=np.float64)
+            if x.ndim == 1:
+                x = x[None]
+            n_traces, n = x.shape
+            self.n_frames_ = n
+            sums = np.zeros((n_traces, n + 1))
+            np.cumsum(x, axis=1, out=sums[:, 1:])
+            differences = np.zeros((n_traces, n + 1))                          # differences[t] = sum of |x[j + 1] - x[j]| for j < t
+            np.cumsum(np.abs(np.diff(x, axis=1)), axis=1, out=differences[:, 1:n])
+            differences[:, n] = differences[:, n - 1]
+            log_n = np.log(max(n, 2))
+            boundaries = np.zeros((n_traces, n + 1), dtype=bool)               # Segment edges, between frames t - 1 and t
+            boundaries[:, [0, n]] = True
+            positions = np.arange(n + 1)
+            rows = np.arange(n_traces)
+            active = np.ones(n_traces, dtype=bool)                              # Traces that may still have a step
+            for _ in range(self.max_steps):
+                if not active.any():
+                    break
+                start = np.maximum.accumulate(np.where(boundaries, positions, 0), axis=1)          # Last edge at or before t
+                end = np.minimum.accumulate(np.where(boundaries, positions, n)[:, ::-1], axis=1)[:, ::-1]
+                end = np.concatenate((end[:, 1:], np.full((n_traces, 1), n)), axis=1)              # First edge after t
+                left, right = positions - start, end - positions
+                a, t, b = np.take_along_axis(sums, start, 1), sums, np.take_along_axis(sums, end, 1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    # Reduction of the squared error when the segment [a, b) is split at t, from the sums of its two parts, in units of the noise of the segment
+                    gain = (t - a) ** 2 / left + (b - t) ** 2 / right - (b - a) ** 2 / (end - start)
+                    gain /= self.noise(differences, start, end) ** 2
+                gain[(left < self.min_dwell) | (right < self.min_dwell) | boundaries] = -np.inf
+                best = np.argmax(gain, axis=1)
+                accept = active & (gain[rows, best] > self.penalty * log_n)
+                boundaries[rows[accept], best[accept]] = True
+                active = accept
+            self.fit_levels(sums, differences, boundaries)
+            return self
+
+        def fit_levels(self, sums, differences, boundaries):     # Change points, segment levels and the bleach summary of every trace
+            self.change_points_, self.levels_ = [], []
+            self.bleach_steps_ = np.zeros(len(sums), dtype=int)
+            self.last_bleach_ = np.full(len(sums), -1)                          # First frame after the last downward step, -1 without one
+            self.step_snr_ = np.zeros(len(sums))
+            for i, edges in enumerate(boundaries):
+                edges = np.nonzero(edges)[0]
+                levels = np.diff(sums[i, edges]) / np.diff(edges)
+                self.change_points_.append(edges[1:-1])
+                self.levels_.append(levels)
+                down = np.nonzero(np.diff(levels) < 0)[0]
+                self.bleach_steps_[i] = down.size
+                if down.size:                                                   # Noise of the two segments around the last bleach step
+                    self.last_bleach_[i] = edges[1:-1][down[-1]]
+                    sigma = self.noise(differences[i:i + 1], edges[None, None, down[-1]], edges[None, None, down[-1] + 2])[0, 0]
+                    self.step_snr_[i] = (levels[down[-1]] - levels[down[-1] + 1]) / sigma
+            return self
+
+        def predict(self):                      # Rank of the level of every frame among the segments of its trace, (n_traces, n_frames) of the fitted traces
+            n = self.n_frames_
+            states = np.zeros((len(self.levels_), n), dtype=int)
+            for i, (change_points, levels) in enumerate(zip(self.change_points_, self.levels_)):
+                ranks = np.argsort(np.argsort(levels, kind='stable'), kind='stable')
+                states[i] = np.repeat(ranks, np.diff(np.concatenate(([0], change_points, [n]))))
+            return states
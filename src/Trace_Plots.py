@@ -0,0 +1,134 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Stage_Profiler import NULL_PROFILER, peak_rss_mb
+
+# Rendering of the trace figures (C_, PR_ and PE_ PNGs), separated from the analysis.
+#
+#   'all'      every figure is drawn while the traces are processed (default, as before)
+#   'lazy'     the trace figures are drawn by a pool of processes while the analysis goes on, close() waits for them
+#   'summary'  only the 2-D histogram and the maximum projection are drawn, no trace figures
+#   'none'     no figures at all
+#
+# A Trace_Figure is built once and reused for every trace, only the data of the line, the state scatters and the
+# marker of the last state change are updated. Figure() is used without pyplot, so nothing depends on the GUI backend.
+# In the lazy mode the plot_traces stage of the profiler only times the queueing, close() adds the CPU time and peak
+# memory of the rendering processes to it.
+
+PLOT_MODES = ('all', 'lazy', 'summary', 'none')
+STATE_COLORS = {0: "r", 1: "g", 2: "b", 3: "c", 4: "m"}    # Same colors as BBM_Class.plot_emissions
+
+class Trace_Figure:                     # One figure and axes, same layout as BBM_Class.plot_emissions
+        def __init__(self):
+            from matplotlib.figure import Figure    # Imported with the first figure, not with the analysis
+            self.fig = Figure(figsize=(10, 6))
+            self.ax = self.fig.subplots(1, 1)
+            self.line, = self.ax.plot([], [], color='k', alpha=0.5)
+            self.ax.set_xlabel('Time, s')
+            self.scatters = {state: self.ax.scatter([], [], label=f'State {state}', color=color) for state, color in STATE_COLORS.items()}
+            self.last_change = self.ax.axvline(x=0, color='black', linestyle='--')
+            self.last_change_text = self.ax.text(0, 0, '', rotation=90, verticalalignment='bottom', color='black')
+
+        def draw(self, time, trace, states, mono=False, lable_Oy='Detected Counts'):
+            self.line.set_data(time, trace)
+            self.ax.set_ylabel(f'{lable_Oy}')
+            for state, scatter in self.scatters.items():
+                state_mask = states == state
+                scatter.set_offsets(np.column_stack((time[state_mask], trace[state_mask])))
+                scatter.set_visible(not mono and state_mask.any())
+            changes = np.where(np.diff(states) != 0)[0]
+            show_change = not mono and changes.size > 0
+            if show_change:
+                last_state_change_x = time[changes[-1] + 1]
+                self.last_change.set_xdata([last_state_change_x, last_state_change_x])
+                self.last_change_text.set_position((last_state_change_x, np.max(trace)))
+                self.last_change_text.set_text(f'{last_state_change_x:.2f}')
+            self.last_change.set_visible(show_change)
+            self.last_change_text.set_visible(show_change)
+            self.ax.relim(visible_only=True)                                     # x limits from the line, as autoscaling a new figure would do
+            self.ax.autoscale_view(scaley=False)
+            self.ax.set_ylim(np.min(trace), np.max(trace))
+
+        def save_trace(self, time, counts, photons_received, photons_emitted, states, mono, trace_path, trace_name):  # The three figures of a trace
+            for prefix, trace, lable_Oy in (('C', counts, 'Detected Counts'),            # C - stands for counts
+                                            ('PR', photons_received, 'Photons Received'),  # PR - stands for Photons Received
+                                            ('PE', photons_emitted, 'Emitted Photons')):   # PE - stands for Photons Emitted
+                self.draw(time, trace, states, mono, lable_Oy)
+                self.fig.savefig(f"{trace_path}/{prefix}_{trace_name}.png")
+
+worker_figure = None                    # Trace_Figure of a rendering process
+
+def render_jobs(jobs):                  # Worker function of the lazy mode: draws a batch of traces with the figure of the process, returns its CPU time and peak memory
+    global worker_figure
+    cpu = time.process_time()
+    if worker_figure is None:
+        worker_figure = Trace_Figure()
+    for job in jobs:
+        worker_figure.save_trace(*job)
+    return len(jobs), time.process_time() - cpu, peak_rss_mb()
+
+class Plot_Renderer:                    # Draws or queues the trace figures according to the plot mode
+        def __init__(self, mode='all', workers=None, batch_size=16, profiler=NULL_PROFILER, mp_context=None):
+            if mode not in PLOT_MODES:
+                raise ValueError(f"Unknown plot mode: {mode}")
+            self.mode = mode
+            self.workers = workers or os.cpu_count() or 1
+            self.batch_size = batch_size    # Traces sent to a rendering process at once
+            self.figure = None
+            self.executor = None
+            self.pending = []
+            self.futures = []
+            self.profiler = profiler    # Gets the CPU time of the rendering processes in its plot_traces stage
+            self.mp_context = mp_context    # multiprocessing context of the rendering processes, the default one of the platform by default
+
+        @property
+        def summary(self):              # Histogram and maximum projection figures
+            return self.mode != 'none'
+
+        @property
+        def traces(self):               # Trace figures
+            return self.mode in ('all', 'lazy')
+
+        def render_trace(self, time, counts, photons_received, photons_emitted, states, mono, trace_path, trace_name):
+            if not self.traces:
+                return
+            job = (np.asarray(time), np.asarray(counts), np.asarray(photons_received), np.asarray(photons_emitted), np.asarray(states), mono, trace_path, trace_name)
+            if self.mode == 'all':
+                if self.figure is None:
+                    self.figure = Trace_Figure()
+                self.figure.save_trace(*job)
+                return
+            self.pending.append(job)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+        def flush(self):                # Send the queued traces to the rendering processes
+            if not self.pending:
+                return
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+            self.futures.append(self.executor.submit(render_jobs, self.pending))
+            self.pending = []
+
+        def close(self):                # Wait for all the queued figures, errors of the rendering processes are raised here
+            self.flush()
+            try:
+                cpu, peak = 0.0, None
+                for future in self.futures:
+                    _, job_cpu, job_peak = future.result()
+                    cpu, peak = cpu + job_cpu, max(peak or 0, job_peak) if job_peak is not None else peak
+                if self.futures:
+                    self.profiler.merge({'plot_traces': {'calls': 0, 'wall_s': 0.0, 'cpu_s': cpu, 'peak_rss_mb': peak, 'items': {},
+                                                         'notes': ["cpu_s and peak_rss_mb include the rendering processes of the lazy mode, wall_s only the queueing"]}})
+            finally:
+                self.futures = []
+                if self.executor is not None:
+                    self.executor.shutdown()
+                    self.executor = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
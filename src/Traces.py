@@ -0,0 +1,73 @@
+import numpy as np
+from BBM_Functions import BBM_Class
+BBM = BBM_Class()                       # Create an instance of the class
+
+# Counts of all the particles of a movie, with the time as a separate axis and the photon conversions computed on demand.
+#
+#   traces = Trace_Matrix(BBM.time_axis(n_frames, frame_interval), BBM.extract_counts(data, positions, quantity, box=3))
+#   traces.set_conversion(pre_amplifier_gain=5.1, em_gain=285, wavelength=677)
+#   time, counts, photons_received, photons_emitted = traces.trace(12)         # float64 rows of one particle
+#   traces.photons_emitted(slice(0, 256))                                       # block of converted traces
+#   part = traces.select(slice(10, 20), slice(0, 1000))                         # view, nothing is copied
+#
+# The counts keep the dtype of the movie (uint16 for the cameras, float32 for float movies) and are read-only, so the
+# analysis can not change them while the traces are classified. The photons are converted from the counts in float64
+# when they are asked for, with the same BBM_Class.count_convert and recorded_to_emitted as a whole matrix.
+# emissions() gives the old matrix with the time in row 0 for the BBM_Class methods that expect it.
+
+class Trace_Matrix:
+        def __init__(self, time, counts, pre_amplifier_gain=5.1, em_gain=285, wavelength=677):
+            counts = np.asarray(counts)
+            if counts.ndim != 2 or len(time) != counts.shape[1]:
+                raise ValueError(f"counts of shape {counts.shape} do not match {len(time)} frames")
+            self.time = np.asarray(time, dtype=np.float64)
+            self.counts = counts.view()
+            self.counts.flags.writeable = False
+            self.set_conversion(pre_amplifier_gain, em_gain, wavelength)
+
+        @classmethod
+        def from_emissions(cls, emissions, **conversion):  # Matrix with the time in row 0, as returned by extract_intensities_max
+            emissions = np.asarray(emissions)
+            return cls(emissions[0], emissions[1:].astype(np.float32), **conversion)
+
+        def set_conversion(self, pre_amplifier_gain=5.1, em_gain=285, wavelength=677):   # Camera settings used by the photon conversions
+            self.conversion = {'pre_amplifier_gain': pre_amplifier_gain, 'em_gain': em_gain, 'wavelength': wavelength}
+
+        @property
+        def n_traces(self):
+            return self.counts.shape[0]
+
+        @property
+        def n_frames(self):
+            return self.counts.shape[1]
+
+        def __len__(self):
+            return self.n_traces
+
+        @property
+        def nbytes(self):
+            return self.counts.nbytes + self.time.nbytes
+
+        def select(self, traces=slice(None), frames=slice(None)):  # Traces and frames as a new Trace_Matrix, a view of the counts for slices
+            return Trace_Matrix(self.time[frames], self.counts[traces, frames], **self.conversion)
+
+        def photons_received(self, traces=slice(None), frames=slice(None)):   # Photons received by the camera, float64
+            conversion = self.conversion
+            return BBM.count_convert(self.counts[traces, frames].astype(np.float64), pre_amplifier_gain = conversion['pre_amplifier_gain'],
+                                     em_gain = conversion['em_gain'], wavelength = conversion['wavelength'])
+
+        def photons_emitted(self, traces=slice(None), frames=slice(None)):    # Photons emitted by the sample, float64
+            return self.photons(traces, frames)[1]
+
+        def photons(self, traces=slice(None), frames=slice(None)):            # Both conversions, the received photons are converted once
+            received = self.photons_received(traces, frames)
+            return received, BBM.recorded_to_emitted(received, wavelength = self.conversion['wavelength'])
+
+        def trace(self, i):             # time, counts, photons received and photons emitted of trace i as float64 rows
+            return (self.time, self.counts[i].astype(np.float64)) + self.photons(i)
+
+        def emissions(self, traces=None):   # float64 matrix with the time in row 0 and the listed traces (all by default) in the next rows
+            counts = self.counts if traces is None else self.counts[traces]
+            emissions = np.empty((len(counts) + 1, self.n_frames))
+            emissions[0], emissions[1:] = self.time, counts
+            return emissions
@@ -0,0 +1,163 @@
+import os
+os.environ['MPLBACKEND'] = 'Agg'        # Figures are only drawn to measure plot_emissions, matplotlib is imported there
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from BBM_Functions import BBM_Class, preload_modules
+from Batch import DEFAULT_PARAMETERS, analyse_movie
+from Results_Store import load_results
+from benchmarks.Synthetic_Movie import synthetic_movie, save_movie
+BBM = BBM_Class()                       # Create an instance of the class
+
+# Speed and accuracy of the analysis on synthetic movies (see Synthetic_Movie.py), run from the src folder:
+#
+#   python -m benchmarks.Run_Benchmarks                          # every sweep
+#   python -m benchmarks.Run_Benchmarks --sweep frames --quick --output bench.json
+#
+# For every movie of a sweep the BBM_Class methods are timed one by one (best of --repeat runs), then the full
+# analysis of Batch.py runs on the movie saved as a TIF. The particles found are matched to the true positions to
+# give the detection recall and precision, and the last state change of the 2-state traces is compared with the
+# true last bleach frame.
+
+BASE_MOVIE = {'n_frames': 500, 'shape': (128, 128), 'n_particles': 20}
+SWEEPS = {'frames': ('n_frames', (250, 500, 1000, 2000)),
+          'pixels': ('shape', ((64, 64), (128, 128), (256, 256), (512, 512))),
+          'particles': ('n_particles', (5, 10, 20, 40))}
+QUICK_SWEEPS = {'frames': ('n_frames', (200, 400)), 'pixels': ('shape', ((64, 64), (128, 128))), 'particles': ('n_particles', (5, 10))}
+MATCH_RADIUS = 3                        # Pixels between a detected and a true particle to count as found
+BLEACH_TOLERANCE = 5                    # Frames between the detected and the true last bleach to count as correct
+
+def best_time(function, *args, repeat=3, **kwargs):  # Shortest of repeat runs and the result of the last run
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def benchmark_methods(movie, h=0.3, frame_interval=11, repeat=3, max_traces=10):  # Time of every BBM_Class method of the analysis on the movie, in seconds
+    times = {}
+    times['preprocess'], (data, max_frame) = best_time(lambda: BBM.preprocess(movie.copy()), repeat=repeat)
+    times['locate_maxima_batch'], maxima = best_time(BBM.locate_maxima_batch, data, h, 5, repeat=repeat)
+    times['histogram_2d_gradient'], histogram_2d = best_time(BBM.histogram_2d_gradient, movie.shape, maxima, repeat=repeat)
+    times['locate_maxima'], (_, positions, quantity) = best_time(BBM.locate_maxima, histogram_2d, 4, 5, repeat=repeat)
+    if quantity == 0:
+        return times
+    times['extract_intensities_max'], emissions = best_time(BBM.extract_intensities_max, movie, np.array(positions), quantity, frame_interval, repeat=repeat)
+    times['count_convert'], photons_received = best_time(BBM.count_convert, emissions[1:], repeat=repeat)
+    times['recorded_to_emitted'], _ = best_time(BBM.recorded_to_emitted, photons_received, repeat=repeat)
+
+    traces = range(min(quantity, max_traces))   # The HMM steps are timed per trace, on the first max_traces traces
+    preload_modules()                           # hmmlearn, sklearn and pyplot are imported before the timings, as in the worker of Main.py
+    times['states_assignment'], states = best_time(lambda: [BBM.states_assignment(2, emissions, i, random_state=i) for i in traces], repeat=1)
+    times['calculate_silhouette'], _ = best_time(lambda: [BBM.calculate_silhouette(emissions, states[i], i) for i in traces], repeat=repeat)
+    import matplotlib.pyplot as plt
+    times['plot_emissions'], _ = best_time(lambda: [plt.close(BBM.plot_emissions(emissions, i, states[i])[0]) for i in traces], repeat=1)
+    for name in ('states_assignment', 'calculate_silhouette', 'plot_emissions'):
+        times[name] /= len(traces)      # Seconds per trace
+    return times
+
+def match_particles(detected, true_positions, radius=MATCH_RADIUS):   # Pairs (detected index, true index) closest first, each particle used once
+    detected = np.asarray(detected, dtype=np.float64).reshape(-1, 2)
+    distances = np.hypot(*(detected[:, None, :] - true_positions[None, :, :]).transpose(2, 0, 1))
+    pairs, used_detected, used_true = [], set(), set()
+    for d, t in zip(*np.unravel_index(np.argsort(distances, axis=None), distances.shape)):
+        if distances[d, t] > radius:
+            break
+        if d not in used_detected and t not in used_true:
+            pairs.append((int(d), int(t)))
+            used_detected.add(d)
+            used_true.add(t)
+    return pairs
+
+def last_state_change(states):          # Frame of the last state change of a trace, None for a single state
+    changes = np.where(np.diff(states) != 0)[0]
+    return int(changes[-1] + 1) if changes.size else None
+
+def accuracy(results, truth):           # Detection recall/precision and bleach time errors of an analysis against the ground truth
+    pairs = match_particles(results.positions, truth['positions'])
+    n_detected, n_true = len(results.positions), len(truth['positions'])
+    errors, missed_steps = [], 0
+    for d, t in pairs:
+        true_bleach = truth['last_bleach'][t]
+        if true_bleach >= truth['n_frames'] - 1:                    # Still emitting at the end of the movie, no step to find
+            continue
+        detected_bleach = last_state_change(results.trace(d)['states']) if results.number_of_states[d] >= 2 else None
+        if detected_bleach is None:
+            missed_steps += 1
+        else:
+            errors.append(abs(detected_bleach - true_bleach))
+    errors = np.array(errors)
+    return {'true_particles': n_true, 'detected_particles': n_detected, 'matched': len(pairs),
+            'recall': len(pairs) / n_true if n_true else None, 'precision': len(pairs) / n_detected if n_detected else None,
+            'steps_found': len(errors), 'steps_missed': missed_steps,
+            'bleach_error_mean': float(errors.mean()) if errors.size else None, 'bleach_error_median': float(np.median(errors)) if errors.size else None,
+            'bleach_within_tolerance': float(np.mean(errors <= BLEACH_TOLERANCE)) if errors.size else None}
+
+def benchmark_pipeline(movie, truth, parameters=None, folder=None):  # Full analysis of Batch.py on the movie: wall time, stage profile and accuracy
+    parameters = dict(DEFAULT_PARAMETERS, **dict({'h': 0.3, 'plots': 'none', 'legacy_txt': False, 'profile': True}, **(parameters or {})))
+    with tempfile.TemporaryDirectory(dir=folder) as directory:
+        path = os.path.join(directory, "synthetic.tif")
+        save_movie(path, movie)
+        start = time.perf_counter()
+        results_path, _ = analyse_movie(path, parameters)
+        wall = time.perf_counter() - start
+        with load_results(results_path) as results:
+            report = {'wall_s': wall, 'accuracy': accuracy(results, truth)}
+        if parameters['profile']:
+            with open(os.path.join(results_path, "Profile.json")) as f:
+                report['stages'] = {name: stage['wall_s'] for name, stage in json.load(f)['stages'].items()}
+    return report
+
+def run_sweep(name, values, base=BASE_MOVIE, parameters=None, repeat=3, seed=0):  # Benchmark every movie of a sweep, one value of the swept setting at a time
+    setting, _ = SWEEPS[name]
+    reports = []
+    for value in values:
+        movie_settings = dict(base, **{setting: value})
+        movie, truth = synthetic_movie(seed=seed, **movie_settings)
+        print(f"{name}: {setting} = {value}")
+        report = {'sweep': name, 'movie': {key: list(v) if isinstance(v, tuple) else v for key, v in movie_settings.items()}}
+        report['methods_s'] = benchmark_methods(movie, h=(parameters or {}).get('h', 0.3), repeat=repeat)
+        report['pipeline'] = benchmark_pipeline(movie, truth, parameters)
+        print_report(report)
+        reports.append(report)
+    return reports
+
+def print_report(report):
+    for method, seconds in report['methods_s'].items():
+        print(f"    {method:<26}{seconds * 1000:10.2f} ms")
+    result = report['pipeline']['accuracy']
+    print(f"    {'pipeline':<26}{report['pipeline']['wall_s'] * 1000:10.2f} ms   recall {result['recall']}   precision {result['precision']}")
+    print(f"    bleach error: mean {result['bleach_error_mean']} median {result['bleach_error_median']} frames, "
+          f"{result['bleach_within_tolerance']} within {BLEACH_TOLERANCE} frames, {result['steps_missed']} steps missed")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Speed and accuracy benchmarks of BBM on synthetic movies")
+    parser.add_argument('--sweep', choices=tuple(SWEEPS) + ('all',), default='all', help="Setting varied between the movies")
+    parser.add_argument('--quick', action='store_true', help="Small movies, for a fast check")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of every method, the shortest time is kept")
+    parser.add_argument('--params', default=None, help="JSON file with Batch.py parameters used for the full analysis")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    parameters = None
+    if args.params:
+        with open(args.params) as f:
+            parameters = json.load(f)
+    sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+    base = dict(BASE_MOVIE, n_frames=200, shape=(64, 64), n_particles=5) if args.quick else BASE_MOVIE
+    reports = []
+    for name in (sweeps if args.sweep == 'all' else (args.sweep,)):
+        reports += run_sweep(name, sweeps[name][1], base, parameters, args.repeat, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+        print(f"Results saved to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
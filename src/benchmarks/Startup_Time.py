@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Startup time of the analysis, each measurement in a fresh interpreter started from the src folder:
+#
+#   python -m benchmarks.Startup_Time                    # --repeat 5 --output startup.json
+#
+# 'import <module>' is the time to import the module alone, which is what a click on Start waits for before the first
+# window. 'preload_modules' is the time of the heavy modules (sep, cv2, matplotlib, hmmlearn, sklearn, ...) that are
+# now imported by the stages that use them, or ahead of time by the worker process of Main.py, and 'import everything'
+# is what every analysis paid before its first window when Main.py started a new interpreter for GUIs.py.
+# With a display, 'first window' also opens and draws a Tk window after importing GUIs.
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEASUREMENTS = {'import BBM_Functions': "import BBM_Functions",
+                'import Pipeline': "import Pipeline",
+                'import Batch': "import Batch",
+                'import Live': "import Live",
+                'preload_modules': "from BBM_Functions import preload_modules; start = time.perf_counter(); preload_modules()",
+                'import everything': "import Pipeline; from BBM_Functions import preload_modules; preload_modules()"}
+FIRST_WINDOW = ("import GUIs; import tkinter as tk; root = tk.Tk(); root.update_idletasks(); root.update(); root.destroy()")
+
+def measure(code, repeat=5):            # Shortest wall time of the code in repeat fresh interpreters, in seconds. The code may reset start
+    script = f"import time; start = time.perf_counter(); {code}; print(time.perf_counter() - start)"
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], cwd=SRC_PATH, capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError(output.stderr.strip().splitlines()[-1])
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time of the BBM analysis")
+    parser.add_argument('--repeat', type=int, default=5, help="Interpreters started per measurement, the shortest time is kept")
+    parser.add_argument('--output', default=None, help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    measurements = dict(MEASUREMENTS)
+    if os.environ.get('DISPLAY') or sys.platform in ('win32', 'darwin'):
+        measurements['first window'] = FIRST_WINDOW
+    report = {}
+    for name, code in measurements.items():
+        try:
+            report[name] = measure(code, args.repeat)
+            print(f"    {name:<26}{report[name] * 1000:10.1f} ms")
+        except RuntimeError as e:       # e.g. tkinterdnd2 not installed
+            print(f"    {name:<26}    failed: {e}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from Pipeline import classify_chunk, HMM_BACKENDS
+from Traces import Trace_Matrix
+from benchmarks.Synthetic_Movie import synthetic_traces
+
+# Speed and accuracy of the trace classification backends on synthetic traces with a known number of bleach steps, run from the src folder:
+#
+#   python -m benchmarks.Step_Benchmarks                            # 300 traces of 1000 frames, every backend
+#   python -m benchmarks.Step_Benchmarks --photons 30 60 120 --backends fast steps --output steps.json
+#
+# For every signal level (photons of one fluorophore on the pixel) the traces are classified with the hmmlearn, fast and
+# steps backends as in the analysis (chunks of CHUNK_SIZES traces, one process). The report gives the time per trace, the
+# accuracy of the positive/false-positive decision (a trace is positive when it has at least one step), the fraction of
+# traces whose number of steps is found (an HMM with 2 states finds at most one) and the error of the last bleach frame.
+
+BACKEND_SELECTIONS = {'hmmlearn': 'silhouette', 'fast': 'silhouette', 'steps': 'steps'}
+BLEACH_TOLERANCE = 5                    # Frames between the detected and the true last bleach to count as correct
+
+def classify(traces, backend, chunk_size=None):  # Classification of every trace with a backend, in chunks as classify_indices, and the time it took
+    from Pipeline import CHUNK_SIZES
+    chunk_size = chunk_size or CHUNK_SIZES[backend]
+    results = []
+    start = time.perf_counter()
+    for first in range(0, traces.n_traces, chunk_size):
+        indices = list(range(first, min(first + chunk_size, traces.n_traces)))
+        results += classify_chunk(traces.emissions(indices), indices, backend, BACKEND_SELECTIONS[backend])[0]
+    return time.perf_counter() - start, sorted(results, key=lambda result: result[0])
+
+def accuracy(results, truth):           # Decision, step count and last bleach frame against the ground truth
+    positive = np.array([number_of_states >= 2 for _, number_of_states, _, _ in results])
+    true_positive = truth['n_steps'] > 0
+    found_steps = np.array([np.count_nonzero(np.diff(states) < 0) if number_of_states >= 2 else 0 for _, number_of_states, states, _ in results])
+    errors = []
+    for (_, number_of_states, states, _), last_bleach in zip(results, truth['last_bleach']):
+        down = np.nonzero(np.diff(states) < 0)[0]
+        if last_bleach >= 0 and number_of_states >= 2 and down.size:
+            errors.append(abs(down[-1] + 1 - last_bleach))
+    errors = np.array(errors)
+    return {'decision_accuracy': float(np.mean(positive == true_positive)),
+            'recall': float(np.mean(positive[true_positive])) if true_positive.any() else None,
+            'false_positive_rate': float(np.mean(positive[~true_positive])) if (~true_positive).any() else None,
+            'step_count_accuracy': float(np.mean(found_steps == truth['n_steps'])),
+            'bleach_error_median': float(np.median(errors)) if errors.size else None,
+            'bleach_within_tolerance': float(np.mean(errors <= BLEACH_TOLERANCE)) if errors.size else None}
+
+def run(photons_levels=(30, 60, 120), backends=HMM_BACKENDS, n_traces=300, n_frames=1000, max_steps=3, seed=0):
+    reports = []
+    for photons in photons_levels:
+        counts, truth = synthetic_traces(n_traces, n_frames, max_steps, photons=photons, seed=seed)
+        traces = Trace_Matrix(np.arange(n_frames) * 0.011, counts)
+        print(f"photons = {photons}: {n_traces} traces of {n_frames} frames, 0 to {max_steps} steps")
+        for backend in backends:
+            seconds, results = classify(traces, backend)
+            report = {'photons': photons, 'backend': backend, 'ms_per_trace': seconds / n_traces * 1000, **accuracy(results, truth)}
+            print(f"    {backend:<10}{report['ms_per_trace']:8.2f} ms/trace   decision {report['decision_accuracy']:.3f}   "
+                  f"false positives {report['false_positive_rate']:.3f}   step count {report['step_count_accuracy']:.3f}   "
+                  f"last bleach within {BLEACH_TOLERANCE} frames {report['bleach_within_tolerance'] or 0:.3f}")
+            reports.append(report)
+    return reports
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HMM and change-point classification of synthetic traces with known bleach steps")
+    parser.add_argument('--photons', type=int, nargs='+', default=[30, 60, 120], help="Photons of one fluorophore on the pixel")
+    parser.add_argument('--backends', nargs='+', choices=HMM_BACKENDS, default=list(HMM_BACKENDS))
+    parser.add_argument('--traces', type=int, default=300)
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--max-steps', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    reports = run(args.photons, args.backends, args.traces, args.frames, args.max_steps, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+        print(f"Results saved to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Synthetic EMCCD movies of photobleaching single molecules with known positions and bleach times.
+#
+#   movie, truth = synthetic_movie(n_frames=1000, shape=(256, 256), n_particles=50, seed=0)
+#   truth['positions']        (n_particles, 2) y, x of every particle (pixel centers)
+#   truth['bleach_frames']    (n_particles, n_fluorophores) frame where every fluorophore bleaches, sorted
+#   truth['last_bleach']      (n_particles,) frame of the last bleaching step, the step BBM reports for a trace
+#
+#   traces, truth = synthetic_traces(n_traces=500, n_frames=1000, max_steps=3, seed=0)
+#   truth['n_steps']          (n_traces,) bleach steps of every trace, 0 for a spot without fluorophore
+#   truth['bleach_frames']    list of the sorted bleach frames of every trace
+#
+# Every particle holds n_fluorophores emitters with exponential bleach times. Each frame is drawn as Poisson photons,
+# amplified by the EM register (gamma distribution), converted to counts with the pre-amplifier gain and offset by the
+# bias with Gaussian read noise, as in the iXon 897 model used by count_convert.
+
+def place_particles(rng, shape, n_particles, min_distance, margin):    # Random positions at least min_distance apart, margin pixels from the edges
+    positions = []
+    for _ in range(n_particles * 100):
+        if len(positions) == n_particles:
+            break
+        candidate = rng.integers(margin, np.array(shape) - margin)
+        if all(np.hypot(*(candidate - p)) >= min_distance for p in positions):
+            positions.append(candidate)
+    if len(positions) < n_particles:
+        raise ValueError(f"Could not place {n_particles} particles {min_distance} pixels apart in a {shape[0]}x{shape[1]} frame")
+    return np.array(positions, dtype=np.int64).reshape(-1, 2)
+
+def bleach_frames(rng, n_frames, n_particles, n_fluorophores, mean_bleach_frame, min_bleach_frame):  # Sorted bleach frame of every fluorophore
+    frames = min_bleach_frame + rng.exponential(mean_bleach_frame, (n_particles, n_fluorophores))
+    return np.sort(np.minimum(frames, n_frames - 1).astype(np.int64), axis=1)
+
+def emccd_counts(rng, expected, em_gain=285, pre_amplifier_gain=5.1, bias_offset=200, read_noise=6):  # Camera counts for an array of expected photons
+    electrons = rng.poisson(expected)
+    amplified = rng.gamma(np.maximum(electrons, 1), em_gain) * (electrons > 0)    # EM register, no output without input electrons
+    counts = amplified / pre_amplifier_gain + bias_offset + rng.normal(0, read_noise, amplified.shape)
+    return np.clip(np.rint(counts), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+def synthetic_movie(n_frames=1000, shape=(128, 128), n_particles=20, psf_sigma=1.3, photons=300, background_photons=2,
+                    n_fluorophores=1, mean_bleach_frame=None, min_bleach_frame=None, em_gain=285, pre_amplifier_gain=5.1,
+                    bias_offset=200, read_noise=6, min_distance=12, margin=8, chunk_size=256, seed=0):
+    rng = np.random.default_rng(seed)
+    mean_bleach_frame = mean_bleach_frame or n_frames / 3                   # Most particles bleach inside the movie
+    min_bleach_frame = n_frames // 20 if min_bleach_frame is None else min_bleach_frame
+    positions = place_particles(rng, shape, n_particles, min_distance, margin)
+    bleach = bleach_frames(rng, n_frames, n_particles, n_fluorophores, mean_bleach_frame, min_bleach_frame)
+
+    # Photons of one fluorophore on every pixel around the particle, the PSF is a normalized Gaussian integrated on the 7x7 box
+    radius = int(np.ceil(3 * psf_sigma))
+    offsets = np.arange(-radius, radius + 1)
+    psf = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * psf_sigma ** 2))
+    psf *= photons / psf.sum()
+    rows = np.clip(positions[:, 0, None] + offsets, 0, shape[0] - 1)       # (particles, box)
+    cols = np.clip(positions[:, 1, None] + offsets, 0, shape[1] - 1)
+
+    movie = np.empty((n_frames,) + tuple(shape), dtype=np.uint16)
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        frames = np.arange(start, stop)
+        active = (frames[:, None, None] < bleach[None]).sum(axis=2)        # Fluorophores still emitting, (frames, particles)
+        expected = np.full((stop - start,) + tuple(shape), float(background_photons))
+        for p in range(n_particles):
+            expected[:, rows[p, :, None], cols[p, None, :]] += active[:, p, None, None] * psf
+        movie[start:stop] = emccd_counts(rng, expected, em_gain, pre_amplifier_gain, bias_offset, read_noise)
+
+    truth = {'positions': positions, 'bleach_frames': bleach, 'last_bleach': bleach[:, -1], 'shape': tuple(shape), 'n_frames': n_frames,
+             'psf_sigma': psf_sigma, 'photons': photons, 'n_fluorophores': n_fluorophores}
+    return movie, truth
+
+# Traces of single particles (counts of their brightest pixel) with 0 to max_steps fluorophores that all bleach inside the trace,
+# for the step detection benchmarks. photons is the signal of one fluorophore on the pixel
+def synthetic_traces(n_traces=500, n_frames=1000, max_steps=3, photons=60, background_photons=20, min_dwell=None, em_gain=285, pre_amplifier_gain=5.1,
+                     bias_offset=200, read_noise=6, seed=0):
+    rng = np.random.default_rng(seed)
+    min_dwell = min_dwell or n_frames // 50                                  # Frames between two steps and from the ends of the trace
+    n_steps = rng.integers(0, max_steps + 1, n_traces)
+    expected = np.full((n_traces, n_frames), float(background_photons))
+    bleach = []
+    for i, k in enumerate(n_steps):
+        grid = np.arange(min_dwell, n_frames - 2 * min_dwell, min_dwell)      # Steps on a grid with a random offset, at least min_dwell / 2 apart
+        frames = np.sort(rng.choice(grid, k, replace=False) + rng.integers(0, min_dwell // 2 + 1, k)) if k else np.zeros(0, dtype=np.int64)
+        expected[i] += photons * (np.arange(n_frames)[None, :] < frames[:, None]).sum(axis=0)     # Fluorophores still emitting
+        bleach.append(frames)
+    truth = {'n_steps': n_steps, 'bleach_frames': bleach, 'last_bleach': np.array([b[-1] if len(b) else -1 for b in bleach]), 'n_frames': n_frames,
+             'photons': photons, 'background_photons': background_photons}
+    return emccd_counts(rng, expected, em_gain, pre_amplifier_gain, bias_offset, read_noise), truth
+
+def save_movie(path, movie):            # Write the movie as a TIF stack, read by BBM_Class.import_data like a microscope movie
+    import tifffile as tiff
+    tiff.imwrite(path, movie)